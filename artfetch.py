@@ -0,0 +1,177 @@
+import json, os, time
+from os import path
+import httplib, socket
+from urlparse import urlsplit
+from multiprocessing.pool import ThreadPool
+import threading
+import logging
+
+# local imports
+import profiling
+
+# remembers URLs that failed to download, so we don't retry them on every
+# run.  Entries expire after ttl seconds, and the cache is saved to fname
+# (as JSON) whenever it changes
+class NegativeCache:
+    def __init__(self, fname = None, ttl = 24*60*60):
+        self.fname = fname
+        self.ttl = ttl
+        self.failures = {}      # url => time of last failure
+        self.lock = threading.Lock()
+
+        if fname and path.exists(fname):
+            try:
+                with open(fname) as f:
+                    self.failures = json.load(f)
+            except (IOError, ValueError), e:
+                logging.warn("Ignoring unreadable negative cache %s: %s"%(fname, e))
+
+    # locks can't be pickled, e.g. when passing a library to batch workers
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def isBlocked(self, url):
+        failed = self.failures.get(url)
+        return failed is not None and time.time() - failed < self.ttl
+
+    def add(self, url):
+        with self.lock:
+            self.failures[url] = time.time()
+            self.save()
+
+    def discard(self, url):
+        with self.lock:
+            if self.failures.pop(url, None) is not None:
+                self.save()
+
+    def save(self):
+        if not self.fname:
+            return
+        now = time.time()
+        failures = dict((url, t) for (url, t) in self.failures.items()
+            if now - t < self.ttl)
+        try:
+            if not path.exists(path.dirname(self.fname)):
+                os.makedirs(path.dirname(self.fname))
+            tmpFile = self.fname + '.%d'%os.getpid()
+            with open(tmpFile, 'w') as f:
+                json.dump(failures, f)
+            if path.exists(self.fname):
+                os.remove(self.fname)
+            os.rename(tmpFile, self.fname)
+        except (IOError, OSError), e:
+            logging.warn("Couldn't save negative cache %s: %s"%(self.fname, e))
+
+# downloads art files from base_url, relative paths being the same on the
+# server as below the local image folder.  Each thread keeps its own
+# persistent HTTP connection, transient failures (network errors and
+# server errors) are retried with exponential backoff, and URLs that still
+# fail are remembered in the negative cache
+class Fetcher:
+    def __init__(self, base_url, negative_cache = None,
+            retries = 3, backoff = 0.5, timeout = 30):
+        self.base_url = base_url
+        self.negative_cache = negative_cache or NegativeCache()
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    # the calling thread's connection to the server, opened on demand
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            parts = urlsplit(self.base_url)
+            if parts.scheme == 'https':
+                conn = httplib.HTTPSConnection(parts.netloc, timeout=self.timeout)
+            else:
+                conn = httplib.HTTPConnection(parts.netloc, timeout=self.timeout)
+            self.local.conn = conn
+        return conn
+
+    def closeConnection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    # download relpath to fname, returning True on success
+    def fetch(self, relpath, fname):
+        url = self.base_url + relpath
+        if self.negative_cache.isBlocked(url):
+            logging.info("Skipping %s which failed recently"%url)
+            return False
+
+        logging.info("Retrieving %s"%fname)
+        urlpath = urlsplit(url).path
+        with profiling.span('art.download', url=url) as span:
+            for attempt in xrange(self.retries + 1):
+                if attempt:
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+                try:
+                    conn = self.connection()
+                    conn.request('GET', urlpath)
+                    response = conn.getresponse()
+                    data = response.read()
+                except (httplib.HTTPException, socket.error), e:
+                    logging.info("Error retrieving %s: %s"%(url, e))
+                    self.closeConnection()      # start afresh on the next try
+                    continue
+                if response.status == 200:
+                    break
+                logging.info("Error retrieving %s: HTTP %d"%(url, response.status))
+                if response.status < 500:       # no point asking again
+                    break
+            else:
+                response = None
+            span.args['attempts'] = attempt + 1
+            span.args['status'] = response and response.status
+
+        if response is None or response.status != 200:
+            logging.warn("Failed to retrieve %s"%url)
+            self.negative_cache.add(url)
+            return False
+
+        try:
+            if not path.exists(path.dirname(fname)):
+                os.makedirs(path.dirname(fname))
+            # write and rename so readers never see a partial file
+            tmpFile = fname + '.%d-%d.part'%(os.getpid(), threading.current_thread().ident)
+            with open(tmpFile, 'wb') as f:
+                f.write(data)
+            os.rename(tmpFile, fname)
+        except (IOError, OSError), e:
+            logging.warn("Failed to save %s: %s"%(fname, e))
+            return False
+
+        self.negative_cache.discard(url)
+        return True
+
+    # download a list of (relpath, fname) concurrently, returning a
+    # dictionary of relpath => success
+    def fetchAll(self, items, jobs = 8):
+        if not items:
+            return {}
+        pool = ThreadPool(min(jobs, len(items)))
+        try:
+            results = pool.map(lambda (relpath, fname): self.fetch(relpath, fname),
+                items, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return dict(zip([relpath for (relpath, fname) in items], results))
@@ -0,0 +1,91 @@
+import json, mmap, os
+from os import path
+from PIL import Image
+import logging
+
+# a single file of decoded RGBA pixels for all the art images, which is
+# memory-mapped so that images are available without decoding PNGs, and
+# processes rendering in parallel share one copy of the art via the page
+# cache.  The index (atlasFile + '.json') maps each image's relative path
+# to [offset, width, height, mtime, size], the last two being those of the
+# image file it was built from, so that replaced art is noticed
+class Atlas:
+    def __init__(self, atlasFile):
+        self.atlasFile = atlasFile
+        with open(atlasFile + '.json') as f:
+            self.index = json.load(f)
+        self.open()
+
+    def open(self):
+        self.images = {}        # relpath => image view, or None if stale
+        self.map = None
+        with open(self.atlasFile, 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # the map itself can't be pickled, so reopen the file when unpickled
+    def __getstate__(self):
+        return { 'atlasFile' : self.atlasFile, 'index' : self.index }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    # return a read-only image sharing the atlas memory for relpath, or None
+    # if it isn't in the atlas or fname has changed since the atlas was built
+    def getImage(self, relpath, fname):
+        if relpath in self.images:
+            return self.images[relpath]
+
+        image = None
+        entry = self.index.get(relpath)
+        if entry and self.map:
+            (offset, w, h, mtime, size) = entry
+            try:
+                st = os.stat(fname)
+                fresh = int(st.st_mtime) == mtime and st.st_size == size
+            except OSError:
+                fresh = False
+            if fresh:
+                image = Image.frombuffer('RGBA', (w,h),
+                    buffer(self.map, offset, w*h*4), 'raw', 'RGBA', 0, 1)
+            else:
+                logging.info("Atlas entry for %s is out of date"%relpath)
+
+        self.images[relpath] = image
+        return image
+
+    def __len__(self):
+        return len(self.index)
+
+# decode a list of (relpath, fname) images into a new atlas file and index,
+# returning the number of images packed
+def buildAtlas(atlasFile, images):
+    if not path.exists(path.dirname(atlasFile)):
+        os.makedirs(path.dirname(atlasFile))
+
+    index = {}
+    tmpFile = atlasFile + '.%d'%os.getpid()
+    with open(tmpFile, 'wb') as f:
+        for (relpath, fname) in images:
+            try:
+                image = Image.open(fname).convert('RGBA')
+                st = os.stat(fname)
+            except (IOError, OSError), e:
+                logging.warn("Leaving %s out of atlas: %s"%(fname, e))
+                continue
+            index[relpath] = [f.tell(), image.size[0], image.size[1],
+                int(st.st_mtime), st.st_size]
+            f.write(image.tobytes())
+
+    with open(tmpFile + '.json', 'w') as f:
+        json.dump(index, f)
+
+    # remove the old index first and install the new one last, so an index
+    # never refers to the wrong data
+    for suffix in ['.json', '']:
+        if path.exists(atlasFile + suffix):
+            os.remove(atlasFile + suffix)
+    os.rename(tmpFile, atlasFile)
+    os.rename(tmpFile + '.json', atlasFile + '.json')
+    return len(index)
@@ -0,0 +1,279 @@
+#!/usr/bin/python
+import json, os, sys, time
+from os import path
+import random
+import resource
+from argparse import ArgumentParser
+from multiprocessing import Pool, cpu_count
+from tempfile import mkdtemp
+from shutil import rmtree
+
+# local imports
+import drawboard
+import splitimage
+import profiling
+
+# art used to populate synthetic scenarios, by layer
+synthetic_art = {
+    'terrain' : ['hills', 'buildings', 'river', 'curve'],
+    'rect_terrain' : ['bridge', 'bunker'],
+    'obstacle' : ['sand', 'wire', 'hedgehog'],
+    'unit' : ['inf', 'tank'],
+    'badge' : ['badge1'],
+    'tags' : ['medal1']
+}
+
+# a synthetic scenario on a board of the given format and face, with terrain
+# on every hex and a dense mix of obstacles, units (with badges and numbers
+# of figures), multi-tag hexes and labels.  The same seed always gives the
+# same scenario
+def makeScenario(format, face, seed = 0):
+    rnd = random.Random(seed)
+    art = synthetic_art
+    (cols, rows) = drawboard.Board.formats[format]
+
+    hexagons = []
+    labels = []
+    for row in xrange(rows):
+        # odd rows are offset by half a hex, and have one hex fewer
+        for col in xrange(row % 2, 2*cols - 1 - row % 2, 2):
+            hexagon = { 'row' : row, 'col' : col,
+                'terrain' : { 'name' : rnd.choice(art['terrain']),
+                    'orientation' : rnd.randint(1, 6) } }
+            if rnd.random() < 0.2:
+                hexagon['rect_terrain'] = { 'name' : rnd.choice(art['rect_terrain']),
+                    'orientation' : rnd.randint(1, 6) }
+            if rnd.random() < 0.3:
+                hexagon['obstacle'] = { 'name' : rnd.choice(art['obstacle']),
+                    'orientation' : rnd.randint(1, 6) }
+            if rnd.random() < 0.5:
+                unit = { 'name' : rnd.choice(art['unit']),
+                    'nbr_units' : str(rnd.randint(1, 4)) }
+                if rnd.random() < 0.5:
+                    unit['badge'] = rnd.choice(art['badge'])
+                hexagon['unit'] = unit
+            if rnd.random() < 0.2:
+                hexagon['tags'] = [{ 'name' : rnd.choice(art['tags']) }
+                    for i in xrange(rnd.randint(1, 4))]
+            hexagons.append(hexagon)
+
+            if rnd.random() < 0.1:
+                labels.append({ 'row' : row, 'col' : col,
+                    'text' : ['Hill %d'%len(labels), 'Sector %s'%chr(65 + row)][:rnd.randint(1, 2)] })
+
+    return {
+        'game_info' : { 'side_player1' : 'AXIS', 'side_player2' : 'ALLIES',
+            'victory_player1' : 6, 'victory_player2' : 6 },
+        'text' : { 'en' : { 'name' : 'Synthetic %s %s'%(format, face) } },
+        'board' : { 'type' : format.upper(), 'face' : face.upper(),
+            'hexagons' : hexagons, 'labels' : labels }
+    }
+
+# the fastest of repeat runs of fn, in seconds
+def bestTime(fn, repeat = 3):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+# the fastest of repeat profiled runs of fn, in seconds, and the fastest
+# total time of each kind of span (by name, see profiling) in any run
+def profiledTimes(fn, repeat = 3):
+    best = None
+    spans = {}
+    for i in xrange(repeat):
+        profiler = profiling.start()
+        try:
+            start = time.time()
+            fn()
+            elapsed = time.time() - start
+        finally:
+            profiling.stop()
+        if best is None or elapsed < best:
+            best = elapsed
+        for (name, phase) in profiler.summary().items():
+            spans[name] = min(spans.get(name, phase['total_s']), phase['total_s'])
+    return (best, spans)
+
+# peak resident memory of this process so far, in MB
+def peakMemory():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':        # bytes rather than KB
+        peak /= 1024
+    return peak / 1024.
+
+# hides anything printed, like splitimage's choice of tiling
+class NoOutput:
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+# time loading the art index, from the editor XML and from the saved index
+def benchmarkIndex(xml_files, repeat = 3):
+    folder = mkdtemp()
+    try:
+        indexFile = path.join(folder, 'art_index.pickle')
+        def load():
+            drawboard.ArtLibrary(xml_files, drawboard.getImageDir(), None,
+                indexFile = indexFile)
+        def parse():
+            if path.exists(indexFile):
+                os.remove(indexFile)
+            load()
+        return { 'index.parse_s' : bestTime(parse, repeat),
+            'index.load_s' : bestTime(load, repeat) }
+    finally:
+        rmtree(folder)
+
+# time rendering a synthetic board, layer by layer, and then tiling it.
+# Runs in a fresh worker process for each board so peak memory is its own
+def benchmarkBoard((xml_files, format, face, repeat)):
+    icons = drawboard.ArtLibrary(xml_files, drawboard.getImageDir(), None)
+    board = drawboard.Board(makeScenario(format, face))
+    layers = drawboard.Board.drawing_layers
+    results = {}
+
+    # the first render includes building the background plate and loading art
+    start = time.time()
+    image = board.render(icons)
+    results['render.first_s'] = time.time() - start
+    (results['render.all_s'], spans) = profiledTimes(
+        lambda: board.render(icons), repeat)
+    results['render.background_s'] = bestTime(
+        lambda: board.render(icons, layers), repeat)
+    # painting each layer (and the medals and title) within the full render
+    for layer in layers + ['scenario']:
+        results['render.%s_s'%layer] = spans.get('paint.' + layer, 0.)
+
+    # tile on letter paper, timing cropping and encoding within the whole
+    folder = mkdtemp()
+    try:
+        with NoOutput():
+            (results['tiles_s'], spans) = profiledTimes(
+                lambda: splitimage.saveTiledImages(image, path.join(folder, 'page'),
+                    splitimage.page_sizes['letter'], 0.5, 0.25), repeat)
+        results['tiles.crop_s'] = spans.get('tiles.crop', 0.)
+        results['tiles.encode_s'] = spans.get('tiles.save', 0.)
+    finally:
+        rmtree(folder)
+
+    results['peak_mb'] = peakMemory()
+    return ('%s-%s'%(format, face), results)
+
+# time compiling and rendering a synthetic board in horizontal bands on 
+# worker processes, to compare with rendering it on one (render.all_s)
+def benchmarkBands(icons, format, face, bands, repeat = 3):
+    board = drawboard.Board(makeScenario(format, face))
+    renderer = drawboard.BandRenderer(icons, bands)
+    try:
+        renderer.render(board.compile(icons))       # warm up the workers
+        return bestTime(lambda: renderer.render(board.compile(icons)), repeat)
+    finally:
+        renderer.close()
+
+# boards big enough to be worth rendering in bands
+band_formats = ['overlord', 'brkthru']
+
+# run the benchmarks, returning a flat dictionary of results by name
+def runBenchmarks(xml_files, formats, faces, repeat = 3):
+    results = benchmarkIndex(xml_files, repeat)
+    icons = drawboard.ArtLibrary(xml_files, drawboard.getImageDir(), None)
+    for format in formats:
+        for face in faces:
+            pool = Pool(1)
+            try:
+                (name, timings) = pool.apply(benchmarkBoard,
+                    ((xml_files, format, face, repeat),))
+            finally:
+                pool.close()
+                pool.join()
+            for (key, value) in timings.items():
+                results['%s/%s'%(name, key)] = value
+            print "%s: rendered in %.3fs, peak memory %.0fMB"%(
+                name, timings['render.all_s'], timings['peak_mb'])
+            if format in band_formats:
+                bands = cpu_count()
+                results['%s/render.bands_s'%name] = elapsed = benchmarkBands(
+                    icons, format, face, bands, repeat)
+                print "%s: rendered in %.3fs in %d bands (%.1fx)"%(
+                    name, elapsed, bands, timings['render.all_s'] / elapsed)
+    return results
+
+# compare results with a baseline, returning a list of (name, baseline,
+# result) for the regressions: results more than tolerance (a fraction)
+# worse than the baseline, allowing for some absolute noise in timings
+# (slack seconds) and memory (slack_mb)
+def compareResults(baseline, results, tolerance = 0.25, slack = 0.02,
+        slack_mb = 16):
+    regressions = []
+    for (name, value) in sorted(results.items()):
+        if name not in baseline:
+            continue
+        allowed = slack_mb if name.endswith('_mb') else slack
+        if value > baseline[name] * (1 + tolerance) + allowed:
+            regressions.append((name, baseline[name], value))
+    return regressions
+
+def setupArgParser():
+    formats = sorted(drawboard.Board.formats.keys())
+    faces = sorted(drawboard.Board.faces.keys())
+    parser = ArgumentParser(
+        description = "Time rendering synthetic Memoir 44 scenarios, and compare with a baseline")
+    parser.add_argument('-a','--appdir', default=None,
+        help='Pathname of the Memoir 44 Editor folder')
+    parser.add_argument('--baseline', default='bench_baseline.json',
+        help="JSON file of baseline results to compare with")
+    parser.add_argument('--save-baseline', dest='save_baseline', action='store_true',
+        default=False, help="Save these results as the new baseline")
+    parser.add_argument('--output', default=None,
+        help="Also write the results to this JSON file")
+    parser.add_argument('--formats', default=formats, type=lambda s: s.split(','),
+        metavar=','.join(formats), help="Board formats to benchmark")
+    parser.add_argument('--faces', default=faces, type=lambda s: s.split(','),
+        metavar=','.join(faces), help="Board faces to benchmark")
+    parser.add_argument('--repeat', type=int, default=3,
+        help="Number of times to repeat each timing, keeping the fastest")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+        help="Fraction slower than the baseline which counts as a regression")
+    return parser
+
+########################################
+
+if __name__ == "__main__":
+    args = setupArgParser().parse_args()
+
+    icons = drawboard.openArtLibrary(args.appdir)
+    if not icons:
+        sys.exit(-1)
+    # make sure all the art we use is on disk before timing anything
+    for format in args.formats:
+        for face in args.faces:
+            icons.prefetch(drawboard.Board(makeScenario(format, face)).artNames())
+
+    results = runBenchmarks(icons.xml_files, args.formats, args.faces, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.save_baseline or not path.exists(args.baseline):
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print "Saved baseline results to %s"%args.baseline
+        sys.exit(0)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compareResults(baseline, results, args.tolerance)
+    for (name, before, after) in regressions:
+        print "REGRESSION: %s %.3f -> %.3f (%+.0f%%)"%(
+            name, before, after, 100. * (after - before) / before)
+    print "%d of %d results worse than %s"%(
+        len(regressions), len(results), args.baseline)
+    sys.exit(1 if regressions else 0)
@@ -7,13 +7,32 @@ from types import ListType
 import os, sys
 from os import path
 from argparse import ArgumentParser, ArgumentTypeError
-from urllib import urlretrieve
+import cPickle as pickle
+import hashlib
+from glob import glob
+from multiprocessing import Pool, cpu_count, current_process
+from collections import Counter
+import time
+import atexit
+from itertools import groupby
 import operator
 import logging
+import threading
+import base64, mimetypes
+from cStringIO import StringIO
+from urllib import pathname2url
+from urlparse import urljoin
+from xml.sax.saxutils import escape, quoteattr
 
 # local imports
 from xy import XY
 import splitimage
+from artfetch import Fetcher, NegativeCache
+from atlas import Atlas, buildAtlas
+from geometry import HexGeometry
+from outputcache import OutputCache
+from imagecache import ImageCache
+import profiling
 
 logging.basicConfig(level=logging.WARN)
 
@@ -51,17 +70,25 @@ def findBgData():
     fname = path.join(getImageDir(),'bg_data.xml')
     return fname
 
+def getCacheDir(imageDir = None):
+    return path.join(imageDir or getImageDir(), 'cache')  # derived data we can rebuild
+
 # represents the artwork for a tile, tag, unit etc that might be displayed
-# in a hex.  Lazily loads images on request from disk with URL fallback
+# in a hex.  Lazily loads images on request from disk, with a fallback to
+# downloading via the library's fetcher, keeping them in the library's cache
 class Artwork:
+    # attributes saved for each artwork in the precompiled index
+    index_fields = ['base','ext','name','label','type','nbrOrientation']
+    
     # initialize from an XML element containing <icon> and <name> children
     # optional <nbrOrientation> element identifies how many (sequentially
     # numbered) variants of the image there are
-    def __init__(self, elt):
+    def __init__(self, elt = None):
+        if elt is None:     # caller will fill in attributes, see fromIndex
+            return
+            
         (self.base,self.ext) = path.splitext(elt.find('icon').text)
         
-        self.images = {}
-        
         for tag in ['name','label','type','nbrOrientation']:
             kid = elt.find(tag)
             if kid is not None:
@@ -73,36 +100,65 @@ class Artwork:
             self.nbrOrientation = int(self.nbrOrientation)
             self.base = self.base[:-1]
             
-    # request for a particular bitmap of this art
-    def getImage(self, imageDir, imageURL, orientation = 1):
+    # recreate an artwork from a tuple saved by indexEntry
+    @staticmethod
+    def fromIndex(entry):
+        art = Artwork()
+        for (field,value) in zip(Artwork.index_fields, entry):
+            setattr(art,field,value)
+        return art
+        
+    def indexEntry(self):
+        return tuple(getattr(self,field) for field in Artwork.index_fields)
+            
+    # request for a particular bitmap of this art, cached in images (an 
+    # ImageCache) by its relative path
+    def getImage(self, imageDir, fetcher, images, orientation = 1):
         if not orientation: orientation = 1
         
         # check if we've already loaded it
-        if not self.images.has_key(orientation):
-            self.images[orientation] = None # assume the worst
+        relpath = self.getRelativePath(orientation)
+        image = images.get(relpath)
+        if image is not ImageCache.missing:
+            profiling.count('art.memory_hit')
+            return image
             
-            relpath = self.getRelativePath(orientation)
-            fname = path.join(imageDir, relpath)
-            # do we have a file?
-            if not path.exists(fname):
-                url = imageURL + relpath
-                logging.info("Retrieving %s"%fname)
-                if not path.exists(path.dirname(fname)):
-                    os.makedirs(path.dirname(fname))
-                try:
-                    urlretrieve(url, fname)
-                except:
-                    logging.warn("Failed to retrieve %s"%url)
-                    return None
-                    
+        with profiling.span('art.image', relpath=relpath) as span:
+            image = self.loadImage(imageDir, fetcher, relpath, span)
+        return images.put(relpath, image)      # None if we couldn't load it
+    
+    # load the file for relpath, downloading it if we have to, and noting
+    # how it was found (from disk, a download, or failure) in span
+    def loadImage(self, imageDir, fetcher, relpath, span):
+        fname = path.join(imageDir, relpath)
+        source = 'disk'
+        image = None
+        # do we have a file?
+        if not path.exists(fname):
+            source = 'download'
+            if not fetcher:
+                logging.warn("Missing %s"%fname)
+                source = 'failure'
+            elif not fetcher.fetch(relpath, fname):
+                source = 'failure'
+                
+        if source != 'failure':
             try:
-                self.images[orientation] = Image.open(fname)
+                # decode now, so it is timed with the load, threads sharing
+                # the library never load the same image at once, and the 
+                # file is closed
+                with open(fname, 'rb') as f:
+                    image = Image.open(f)
+                    image.load()
             except:
                 logging.warn("Failed to open %s"%fname)
-                return None
-                    
-        return self.images[orientation]
-    
+                source = 'failure'
+                image = None
+                
+        span.args['source'] = source
+        profiling.count('art.' + source)
+        return image
+        
     def getRelativePath(self,orientation = 1):
         if self.nbrOrientation:
             if not orientation: orientation = 1
@@ -110,26 +166,297 @@ class Artwork:
         else:
             return self.base + self.ext
 
+# the set of artworks described by the editor's XML resource files.  Parsing
+# the XML is slow, so the parsed index is saved to indexFile (by default in
+# the image cache folder) and reused until one of the XML files changes.
+# Pass indexFile = False to always parse the XML.
+# Decoded and derived images are kept in memory up to cacheBytes, dropping
+# the least recently used ones beyond that, see cacheStats.
+# Missing images are downloaded from imageURL (unless it is None), and URLs
+# that fail are not retried for a day, see artfetch.NegativeCache.
+# If an atlas of decoded images has been built (see buildAtlas) images are
+# taken from it rather than decoding the PNG files.  Pass atlasFile = False
+# to ignore it.
+# A library can be shared by threads rendering at once
 class ArtLibrary:
-    def __init__(self, xml_files, imageDir, imageURL):
+    index_version = 1       # bump if the saved index format changes
+    label_cache_bytes = 16 * 2**20
+    
+    def __init__(self, xml_files, imageDir, imageURL, indexFile = None,
+            negativeCacheFile = None, atlasFile = None, cacheBytes = 512 * 2**20):
         self.artworks = {}
+        # images by relative path, and derived images by (name, orientation, transforms)
+        self.images = ImageCache(cacheBytes)
+        self.fonts = {}     # label fonts keyed by size
+        # rendered label bitmaps keyed by (text, size)
+        self.labels = ImageCache(ArtLibrary.label_cache_bytes, 'label')
+        self.lock = threading.RLock()   # fonts can't be used by two threads at once
+        self.xml_files = xml_files
         self.imageDir = imageDir
         self.imageURL = imageURL
         
+        self.fetcher = None
+        if imageURL:
+            if negativeCacheFile is None:
+                negativeCacheFile = path.join(getCacheDir(imageDir), 'missing_art.json')
+            self.fetcher = Fetcher(imageURL, NegativeCache(negativeCacheFile))
+        
+        if indexFile is None:
+            indexFile = path.join(getCacheDir(imageDir), 'art_index.pickle')
+        
+        with profiling.span('art.index') as span:
+            entries = None
+            if indexFile:
+                key = ArtLibrary.indexKey(xml_files)
+                entries = ArtLibrary.loadIndex(indexFile, key)
+                span.args['source'] = 'saved'
+            
+            if entries is None:
+                entries = ArtLibrary.parseIndex(xml_files)
+                span.args['source'] = 'parsed'
+                if indexFile:
+                    ArtLibrary.saveIndex(indexFile, key, entries)
+                
+            for entry in entries:
+                art = Artwork.fromIndex(entry)
+                self.artworks[art.name] = art
+            
+        if atlasFile is None:
+            atlasFile = path.join(getCacheDir(imageDir), 'art_atlas.rgba')
+        self.atlasFile = atlasFile
+        self.atlas = None
+        if atlasFile and path.exists(atlasFile + '.json'):
+            try:
+                with profiling.span('art.atlas'):
+                    self.atlas = Atlas(atlasFile)
+            except (IOError, OSError, ValueError), e:
+                logging.warn("Ignoring unreadable atlas %s: %s"%(atlasFile, e))
+    
+    # locks and fonts can't be pickled, e.g. when passing a library to batch
+    # workers, so fonts are loaded again as needed
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        state['fonts'] = {}
+        return state
+        
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+        
+    # the index is only valid for the same XML files, unchanged since it was built
+    @staticmethod
+    def indexKey(xml_files):
+        return (ArtLibrary.index_version, 
+            [(path.abspath(f), os.stat(f).st_mtime) for f in xml_files])
+    
+    # parse the XML files, returning a list of index entries in file order
+    @staticmethod
+    def parseIndex(xml_files):
+        entries = []
         for xml_file in xml_files:
             xml = ElementTree(file=xml_file)
             for elt in xml.getiterator():
                 if elt.find('icon') is not None:
                     art = Artwork(elt)
                     if not art.name:
-                        logging.warn('Skiping icon with no name %s'%art.icon)
-                    self.artworks[art.name] = art  
+                        logging.warn('Skiping icon with no name %s'%(
+                            art.base + art.ext))
+                    entries.append(art.indexEntry())
+        return entries
+        
+    # return saved index entries, or None if missing, unreadable or out of date
+    @staticmethod
+    def loadIndex(indexFile, key):
+        try:
+            with open(indexFile, 'rb') as f:
+                (saved_key, entries) = pickle.load(f)
+        except Exception:
+            return None
+        if saved_key != key:
+            logging.info("Art index %s is out of date"%indexFile)
+            return None
+        return entries
+        
+    @staticmethod
+    def saveIndex(indexFile, key, entries):
+        try:
+            if not path.exists(path.dirname(indexFile)):
+                os.makedirs(path.dirname(indexFile))
+            # write and rename so concurrent readers never see a partial file
+            tmpFile = indexFile + '.%d'%os.getpid()
+            with open(tmpFile, 'wb') as f:
+                pickle.dump((key, entries), f, pickle.HIGHEST_PROTOCOL)
+            if path.exists(indexFile):
+                os.remove(indexFile)
+            os.rename(tmpFile, indexFile)
+        except (IOError, OSError), e:
+            logging.warn("Couldn't save art index %s: %s"%(indexFile, e))
                     
-    def getImage(self,name,orientation=1):  
+    # fetch an image, optionally resampled by a scale factor
+    def getImage(self,name,orientation=1,scale=1):  
+        if scale != 1:
+            return self.getDerived(name, orientation, (('scale', scale),))
         if not self.artworks.has_key(name):
             return None
         
-        return self.artworks[name].getImage(self.imageDir, self.imageURL, orientation)
+        art = self.artworks[name]
+        if self.atlas:
+            relpath = art.getRelativePath(orientation)
+            image = self.atlas.getImage(relpath, path.join(self.imageDir, relpath))
+            if image:
+                profiling.count('art.atlas_hit')
+                return image
+        return art.getImage(self.imageDir, self.fetcher, self.images, orientation)
+        
+    # resident bytes, hits, misses, evictions and reloads of the image cache
+    # (or of the label cache, with labels)
+    def cacheStats(self, labels = False):
+        return (self.labels if labels else self.images).stats()
+        
+    # pack every image (and orientation) we have on disk into an atlas of 
+    # decoded images, and use it from now on.  Returns the number of images
+    def buildAtlas(self):
+        images = []
+        for art in self.artworks.values():
+            for orientation in xrange(1, (art.nbrOrientation or 1) + 1):
+                relpath = art.getRelativePath(orientation)
+                fname = path.join(self.imageDir, relpath)
+                if path.exists(fname):
+                    images.append((relpath, fname))
+        count = buildAtlas(self.atlasFile, sorted(set(images)))
+        self.atlas = Atlas(self.atlasFile)
+        return count
+        
+    # the image transforms available to getDerived, by name
+    transforms = {
+        # resample by a factor, e.g. for rendering at print resolution
+        'scale' : lambda image, factor: image.resize(
+            [max(1, int(round(v * factor))) for v in image.size], Image.ANTIALIAS),
+        # resample by a factor, truncating the new size
+        'enlarge' : lambda image, factor: image.resize(
+            (XY(*image.size) * factor).ints(), Image.ANTIALIAS),
+        'resize' : lambda image, size: image.resize(size, Image.ANTIALIAS),
+        'trim' : lambda image: image.crop(image.getbbox()),
+        'flip' : lambda image: ImageOps.flip(image)
+    }
+    
+    # fetch an image derived from some art by a chain of transforms like 
+    # (('scale', 2.0), ('trim',), ('flip',)), see ArtLibrary.transforms.
+    # Each derived image is only computed once, and the intermediate
+    # results are cached too
+    def getDerived(self, name, orientation = 1, transforms = ()):
+        if not transforms:
+            return self.getImage(name, orientation)
+            
+        key = (name, orientation or 1, tuple(transforms))
+        image = self.images.get(key)
+        if image is not ImageCache.missing:
+            profiling.count('derived.hit')
+            return image
+            
+        profiling.count('derived.miss')
+        image = self.getDerived(name, orientation, transforms[:-1])
+        if image:
+            if image.mode not in ('RGB','RGBA','L','LA'):
+                image = image.convert('RGBA')
+            transform = transforms[-1]
+            image = ArtLibrary.transforms[transform[0]](image, *transform[1:])
+        return self.images.put(key, image)
+        
+    # how each transform changes an image's size, for those that don't
+    # depend on its contents
+    sizers = {
+        'scale' : lambda (w,h), factor: tuple(
+            max(1, int(round(v * factor))) for v in (w,h)),
+        'enlarge' : lambda (w,h), factor: (XY(w,h) * factor).ints(),
+        'resize' : lambda (w,h), size: tuple(size),
+        'flip' : lambda (w,h): (w,h)
+    }
+    
+    # the size of getDerived's image, or None if there is no such art.  
+    # Sizes are worked out without resampling where possible
+    def getSize(self, name, orientation = 1, transforms = ()):
+        if all(t[0] in ArtLibrary.sizers for t in transforms):
+            image = self.getImage(name, orientation)
+            if not image:
+                return None
+            size = image.size
+            for transform in transforms:
+                size = ArtLibrary.sizers[transform[0]](size, *transform[1:])
+            return tuple(size)
+        image = self.getDerived(name, orientation, transforms)
+        return image and image.size
+        
+    # the file holding some art, or None if it isn't on disk
+    def getFileName(self, name, orientation = 1):
+        art = self.artworks.get(name)
+        if not art:
+            return None
+        fname = path.join(self.imageDir, art.getRelativePath(orientation))
+        return fname if path.exists(fname) else None
+        
+    # the font used for labels at a given size, loaded once
+    def getFont(self, size):
+        with self.lock:
+            if not self.fonts.has_key(size):
+                try:
+                    self.fonts[size] = ImageFont.truetype('verdanab.ttf',size)
+                except:
+                    logging.warn("Couldn't open VerdanaBold TTF, using (ugly) system default")
+                    self.fonts[size] = ImageFont.load_default()
+            return self.fonts[size]
+        
+    # a label rendered in black at some font size, returned as (mask, size) 
+    # where mask is an 'L' image to paste black through at the same position 
+    # the text would be drawn, and size is its measured text size 
+    def getLabel(self, text, size):
+        key = (text, size)
+        with self.lock:
+            mask = self.labels.get(key)
+            if mask is not ImageCache.missing:
+                profiling.count('label.hit')
+            else:
+                profiling.count('label.miss')
+                font = self.getFont(size)
+                mask = Image.new('L', font.getsize(text), 0)
+                ImageDraw.Draw(mask).text((0,0), text, fill=255, font=font)
+                self.labels.put(key, mask)
+            return (mask, XY(*mask.size))
+    
+    # download any missing files for a list of (name, orientation) pairs
+    # concurrently, rather than one at a time as each image is first used
+    def prefetch(self, names, jobs = 8):
+        if not self.fetcher:
+            return
+        items = []
+        for (name, orientation) in set(names):
+            art = self.artworks.get(name)
+            if not art:
+                continue
+            relpath = art.getRelativePath(orientation)
+            fname = path.join(self.imageDir, relpath)
+            if not path.exists(fname):
+                items.append((relpath, fname))
+        with profiling.span('art.prefetch', count=len(items)):
+            self.fetcher.fetchAll(items, jobs)
+        
+    # a digest identifying the current files behind some (name, orientation)
+    # pairs, which changes whenever any of that art is replaced on disk
+    def fingerprint(self, names):
+        digest = hashlib.sha1()
+        for (name, orientation) in names:
+            art = self.artworks.get(name)
+            if not art:
+                digest.update('%s:missing;'%name)
+                continue
+            relpath = art.getRelativePath(orientation)
+            try:
+                st = os.stat(path.join(self.imageDir, relpath))
+                digest.update('%s:%s:%d:%d;'%(name, relpath, st.st_mtime, st.st_size))
+            except OSError:
+                digest.update('%s:%s:missing;'%(name, relpath))
+        return digest.hexdigest()
     
 class Board:
     hexXY = XY(188,217)                 # size of tile images in pixels
@@ -162,17 +489,18 @@ class Board:
         'text'          # map label
     ]
         
+    # background terrain for each board face, from the top row down
+    faces = {
+        'country' :     [['countryside']],
+        'winter' :      [['snow']],
+        'beach' :       [['countryside'],['beach'],['coast'],['ocean']],
+        'desert' :      [['desert']]
+        }   
+        
     # return a list of background terrain names based on board format/style
     @staticmethod
     def backgroundTerrain(face, format):
-        faces = {
-            'country' :     [['countryside']],
-            'winter' :      [['snow']],
-            'beach' :       [['countryside'],['beach'],['coast'],['ocean']],
-            'desert' :      [['desert']]
-            }   
-                 
-        names = faces[face]
+        names = Board.faces[face]
         
         if face == 'beach':
             if format == 'brkthru':
@@ -187,20 +515,61 @@ class Board:
     
         return sum(map(operator.mul, names, repeat),[])
             
+    # medal1 - Allies Medal
+    # medal2 - German Medal
+    # <note there isn't a medal3>
+    # medal4 - Victoria Cross
+    # medal5 - Italian Medal of Valor
+    # medal6 - Hero of the Soviet Union Medal
+    # medal7 - Order of the Golden Kite Medal
+    medal_dict = {
+        # Default axis / allies medals in side_player[1|2] value
+        'ALLIES' : 1, 'AXIS' : 2, 
+        # Country-specific medals, coded in country_player[1|2] value
+        'US' : 1, 'DE' : 2, 'GB' : 4, 'IT' : 5, 'RU' : 6, 'JP' : 7
+    }
+        
+    # background plates (empty boards), shared by all boards and kept up to
+    # a budget like the art, and a lock so that threads rendering at once 
+    # build each once
+    plates = ImageCache(64 * 2**20, 'plate')
+    lock = threading.RLock()
+    
     # coordinates - we use a system where each row and column counts 0,1,2,...
-    # with top right starting from 0,0
+    # with top right starting from 0,0.  Optionally scaled from the native
+    # tile size, e.g. for rendering directly at print resolution.  Hexes are
+    # spaced by the scaled tile size (rounded, like the scaled art) so that
+    # neighbouring tiles always meet
     @staticmethod
-    def coords(row, col):
-      xy = Board.hexXY.doti((col + (row%2)/2., row * 3 / 4.))
-      return xy + Board.marginXY
+    def coords(row, col, scale = 1):
+      xy = Board.scaled(Board.hexXY, scale).doti((col + (row%2)/2., row * 3 / 4.))
+      return xy + Board.scaled(Board.marginXY, scale)
     
     # convert from  m44 format where even rows have even cols, odd rows have odd cols
     @staticmethod
-    def coords2(row, col2):
-      return Board.coords(row, (col2 - (row%2))/2)
+    def coords2(row, col2, scale = 1):
+      return Board.coords(row, (col2 - (row%2))/2, scale)
+      
+    # the pixel positions of this board's hexes at the current scale
+    def geometry(self):
+        scale = self.scale
+        return HexGeometry.get(self.cols, self.rows, Board.scaled(Board.hexXY, scale),
+            lambda row, col: Board.coords(row, col, scale), scale)
+        
+    # scale a pixel measure (number or XY) from the native tile size
+    @staticmethod
+    def scaled(value, scale):
+        if isinstance(value, XY):
+            return XY(*[int(round(v * scale)) for v in value])
+        return int(round(value * scale))
 
+    # m44file is a scenario file name, its contents, or an already parsed 
+    # scenario
     def __init__(self, m44file):
-        scenario = json.load(open(m44file))
+        if isinstance(m44file, dict):
+            scenario = m44file
+        else:
+            scenario = json.loads(readScenario(m44file))
         self.info = scenario['board']
         # info is a dictionary with board details like:
         # u'labels': [], 
@@ -221,89 +590,426 @@ class Board:
             self.text['name'] = '(unnamed scenario'
         
         # get the size and background icon generator
-        format,face = self.info['type'].lower(),self.info['face'].lower()
+        self.format = self.info['type'].lower()
+        self.face = self.info['face'].lower()
+        
+        self.cols, self.rows = Board.formats[self.format]
+        self.rowStyles = Board.backgroundTerrain(self.face,self.format)
+        
+        self.scale = 1      # rendering scale relative to native tile size
+        
+    # name of the victory medal image for player '1' or '2'
+    def medalName(self, p):
+        side = self.game_info.get('side_player' + p, '')
+        country = self.game_info.get('country_player' + p, '')
+        
+        medal_num = Board.medal_dict.get(country, None)
+        if not medal_num:
+            medal_num = Board.medal_dict.get(side, None)
+            
+        return 'medal' + (medal_num and `medal_num` or p)
+        
+    # the (name, orientation) of every image needed to render the board,
+    # e.g. to fetch any missing art before rendering
+    def artNames(self, skipLayers = []):
+        names = [('outline',1)] + [(name,1) for name in self.rowStyles]
+        names += [(self.medalName(p),1) for p in ['1','2']]
+        for key in Board.drawing_layers:
+            if key in skipLayers or key in ['lines','text']:
+                continue
+            for hexagon in self.info['hexagons']:
+                content = hexagon.get(key,None)
+                if not content: continue
+                
+                if type(content) is not ListType:
+                    content = [content]
+                for item in content:
+                    names.append((item['name'], item.get('orientation',1) or 1))
+                    if item.has_key('badge'):
+                        names.append((item['badge'],1))
+                    if item.has_key('nbr_units'):
+                        names.append(('nbr_units', int(item['nbr_units'])))
+        return sorted(set(names))
         
-        self.cols, self.rows = Board.formats[format]
-        self.rowStyles = Board.backgroundTerrain(face,format)
+    # size of the rendered board in pixels, excluding the border
+    def size(self):
+        return Board.scaled(Board.marginXY, self.scale) * 2 + \
+            Board.scaled(Board.hexXY, self.scale).doti( (self.cols, (self.rows*3+1)/4.) )
 
-    def render(self, icons, skipLayers = [], hexWidth = 2.0866):
-        # create a blank empty board image with correct size and scaling (DPI)
-        size = Board.marginXY * 2 + \
-            Board.hexXY.doti( (self.cols, (self.rows*3+1)/4.) )
-        board = Image.new('RGB', size, Board.background_color)
-        canvas = ImageDraw.Draw(board)
+    # the empty board with all its background hexes painted, which only 
+    # depends on the format, face and background art.  Plates are built once
+    # and cached on disk in the image cache folder, and in memory (see plates)
+    def backgroundPlate(self, icons):
+        names = [('outline',1)] + [(name,1) for name in set(self.rowStyles)]
+        for (name, orientation) in names:   # make sure art is on disk first
+            icons.getImage(name, orientation)
+        key = (self.format, self.face, self.scale, icons.fingerprint(sorted(names)))
+        
+        with Board.lock:
+            plate = Board.plates.get(key)
+            if plate is not ImageCache.missing:
+                profiling.count('plate.memory_hit')
+                return plate
+            
+            fname = path.join(getCacheDir(icons.imageDir), 'plates', '%s-%s-%s.png'%(
+                self.format, self.face, hashlib.sha1(repr(key)).hexdigest()[:16]))
+            with profiling.span('board.plate') as span:
+                try:
+                    plate = Image.open(fname)
+                    plate.load()
+                    source = 'disk'
+                except (IOError, OSError):
+                    source = 'painted'
+                    plate = self.paintBackground(icons)
+                    try:
+                        if not path.exists(path.dirname(fname)):
+                            os.makedirs(path.dirname(fname))
+                        # other processes may be reading it
+                        tmpFile = fname + '.%d'%os.getpid()
+                        plate.save(tmpFile, 'PNG')
+                        if path.exists(fname):
+                            os.remove(fname)
+                        os.rename(tmpFile, fname)
+                    except (IOError, OSError), e:
+                        logging.warn("Couldn't cache background plate %s: %s"%(fname, e))
+                span.args['source'] = source
+                profiling.count('plate.' + source)
+            
+            return Board.plates.put(key, plate)
+    
+    # paint the background hexes onto target, an image covering the board 
+    # from origin (by default a new image of the whole board)
+    def paintBackground(self, icons, target = None, origin = XY(0,0)):
+        if target is None:
+            target = Image.new('RGB', self.size(), Board.background_color)
+        outline = icons.getImage('outline', 1, self.scale)
+        images = [icons.getImage(name, 1, self.scale) for name in self.rowStyles]
+        for (name, image) in zip(self.rowStyles, images):
+            if not image:
+                logging.warn("No background image for %s"%name)
+        
+        # only visit the hexes with a tile overlapping the target
+        sizes = [image.size for image in images + [outline] if image]
+        if not sizes:
+            return target
+        size = (max(w for (w,h) in sizes), max(h for (w,h) in sizes))
+        geometry = self.geometry()
+        box = tuple(origin) + tuple(origin + target.size)
+        for (row, col) in geometry.overlapping(box, size):
+            image = images[row]
+            if not image:
+                continue
+            xy = geometry.topLeft(row, col)
+            if outline: Board.pasteAt(target, outline, xy, origin)
+            Board.pasteAt(target, image, xy, origin)
+        return target
+        
+    # paste a sprite at board position xy onto target, an image covering the
+    # board from origin, skipping sprites that fall entirely outside target.
+    # Given a color, paint that through the sprite as a mask instead, e.g.
+    # for labels from ArtLibrary.getLabel
+    @staticmethod
+    def pasteAt(target, image, xy, origin, color = None):
+        (x,y) = xy - origin
+        (w,h) = image.size
+        (tw,th) = target.size
+        if x >= tw or y >= th or x + w <= 0 or y + h <= 0:
+            return
+        target.paste(color or image, (x,y), image)
         
+    # the dashed lines between flanks, as a list of vertical line segments
+    # [(x,y),(x,ye)] and their width
+    def flankDashes(self):
+        dash_width = Board.scaled(Board.dash_width, self.scale)
+        dash_length = [Board.scaled(v, self.scale) for v in Board.dash_length]
+        geometry = self.geometry()
+        dashes = []
+        col = 0
+        while col < self.cols:
+            for inc in [4,5,4]:
+               col += inc
+               if col >= self.cols:
+                   break
+                   
+               # Find starting point of dashed flank line
+               (x,y1) = geometry.topLeft(0, col)
+               x -= dash_width / 2 - Board.scaled(2, self.scale)
+               y1 += Board.scaled(Board.hexXY.y, self.scale)/4
+               # Find ending point
+               y2 = geometry.topLeft(self.rows, 0).y
+               
+               # Draw the dashed line
+               y = y1
+               while y < y2:
+                   ye = min(y2, y+dash_length[0])
+                   dashes.append([(x,y),(x,ye)])
+                   y += sum(dash_length)
+                   
+        return dashes, dash_width
+        
+    # choose the rendering scale and return the output DPI.  By default the
+    # art is composited at its native size, and the DPI is chosen so hexes 
+    # print at hexWidth.  Given a target dpi, everything is instead scaled 
+    # to print at hexWidth with that resolution
+    def setResolution(self, hexWidth = 2.0866, dpi = None):
         # use hexWidthto choose a particular hex width in inches
         # actual M44 tiles are 2.0866" (53mm) across the flats
-        dpi = int(round(Board.hexXY.x / hexWidth))
+        if dpi:
+            self.scale = dpi * hexWidth / Board.hexXY.x
+        else:
+            self.scale = 1
+            dpi = int(round(Board.hexXY.x / hexWidth))
+        return dpi
         
-        try:
-            font = ImageFont.truetype('verdanab.ttf',32)
-        except:
-            logging.warn("Couldn't open VerdanaBold TTF, using (ugly) system default")
-            font = ImageFont.load_default()
+    # size of the rendered image in pixels, including the border
+    def outputSize(self, hexWidth = 2.0866, dpi = None):
+        self.setResolution(hexWidth, dpi)
+        return self.size() + XY(2,2) * Board.border_width
+
+    # render the whole board, see setResolution for hexWidth and dpi
+    def render(self, icons, skipLayers = [], hexWidth = 2.0866, dpi = None):
+        layers = [key for key in Board.drawing_layers if key not in skipLayers]
+        return self.renderDisplayList(icons, 
+            self.compile(icons, hexWidth, dpi, layers))
+        
+    # render the whole board from a display list compiled by compile().  The
+    # image is cropped from the background plate at its final size, border 
+    # and all, and painted in place, so it is the only copy of the board made
+    def renderDisplayList(self, icons, displayList, skipLayers = []):
+        self.scale = displayList.scale
+        (w,h) = self.size() + XY(2,2) * Board.border_width
+        # start from the plate if it's small enough to keep in memory, and 
+        # otherwise (e.g. at print scale) paint the background straight onto
+        # the board rather than holding a plate the size of the board beside it
+        (pw, ph) = self.size()
+        usePlate = pw * ph * 4 <= Board.plates.maxBytes
+        return self.renderRegion(icons, displayList, (0,0,w,h), skipLayers, 
+            usePlate)
+        
+    # render just the part of the board inside box (left, upper, right, lower),
+    # in the coordinates of the full image returned by render.  The result
+    # is identical to cropping box from the full image, but only the hexes
+    # and overlays touching box are painted.  With usePlate, the background
+    # is cropped from the board's background plate instead of painted, 
+    # which is quicker when the regions add up to the whole board
+    def renderRegion(self, icons, displayList, box, skipLayers = [], 
+            usePlate = False):
+        self.scale = displayList.scale
+        
+        bw = Board.border_width
+        origin = XY(box[0] - bw, box[1] - bw)
+        if usePlate:
+            # anything outside the plate is border, painted below
+            region = self.backgroundPlate(icons).crop(
+                tuple(origin) + (box[2] - bw, box[3] - bw))
+        else:
+            region = Image.new('RGB', (box[2] - box[0], box[3] - box[1]), 
+                Board.background_color)
+            with profiling.span('paint.background'):
+                self.paintBackground(icons, region, origin)
+        self.paintDisplayList(icons, displayList, region, skipLayers, origin)
+        
+        # draw whatever part of the border lies inside the region, over any 
+        # sprites that run off the board
+        (w,h) = self.size() + XY(2,2) * bw
+        with profiling.span('board.border'):
+            canvas = ImageDraw.Draw(region)
+            for (x0,y0,x1,y1) in [(0,0,w,bw), (0,h-bw,w,h), (0,0,bw,h), (w-bw,0,w,h)]:
+                canvas.rectangle((x0 - box[0], y0 - box[1], 
+                    x1 - box[0] - 1, y1 - box[1] - 1), fill=Board.border_color)
+        region.info['dpi'] = (displayList.dpi,)*2
+        
+        return region
+        
+    # replay a display list onto target, an image covering the board from
+    # origin, skipping any operations for the given layers
+    def paintDisplayList(self, icons, displayList, target, skipLayers = [], 
+            origin = XY(0,0)):
+        canvas = ImageDraw.Draw(target)
+        for (layer, ops) in groupby(displayList.ops, lambda op: op[1]):
+            if layer in skipLayers:
+                continue
             
-        # paint the board background
-        outline = icons.getImage('outline')
-        for row in xrange(self.rows):
-            name = self.rowStyles[row]
-            image = icons.getImage(name)
-            if not image:
-                logging.warn("No background image for %s"%name)
+            # the medals and title aren't in any layer
+            with profiling.span('paint.' + (layer or 'scenario')):
+                for op in ops:
+                    if op[0] == 'sprite':
+                        (_, layer, name, orientation, transforms, x, y) = op
+                        image = icons.getDerived(name, orientation, transforms)
+                        if image:
+                            Board.pasteAt(target, image, XY(x,y), origin)
+                    elif op[0] == 'label':
+                        (_, layer, text, size, x, y) = op
+                        (mask, wh) = icons.getLabel(text, size)
+                        Board.pasteAt(target, mask, XY(x,y), origin, 'black')
+                    elif op[0] == 'lines':
+                        dashes, width = self.flankDashes()
+                        for dash in dashes:
+                            canvas.line([XY(*p) - origin for p in dash],
+                                fill=Board.dash_color, width=width)
+        
+    # an SVG document drawing the board from a display list compiled by 
+    # compile(), as an alternative to renderDisplayList which doesn't 
+    # composite any pixels.  Each distinct sprite (including the background
+    # hexes) is defined once and placed with <use> at the same position it
+    # is pasted, labels are <text> and the flank lines are <line>s.  Sprites
+    # link to their art files, or with embed are included as data URIs.
+    # Art that is trimmed or flipped is always included, since it has no file.
+    # The document prints at dpi (by default the list's) like the raster board
+    def renderSVG(self, icons, displayList, skipLayers = [], dpi = None, 
+            embed = False):
+        self.scale = displayList.scale
+        scaling = (('scale', self.scale),) if self.scale != 1 else ()
+        (w, h) = self.size()
+        bw = Board.border_width
+        (W, H) = (w + 2 * bw, h + 2 * bw)
+        dpi = dpi or displayList.dpi
+        color = lambda rgb: 'rgb(%d,%d,%d)'%rgb
+        
+        defs = {}           # (name, orientation, transforms) => (id, size)
+        ids = {}            # (file or key, size) => (id, size)
+        images = []         # their <image> definitions
+        def define(name, orientation, transforms):
+            key = (name, orientation or 1, tuple(transforms))
+            if key in defs:
+                return defs[key]
+            size = icons.getSize(*key)
+            fname = icons.getFileName(name, orientation or 1)
+            if fname and not all(t[0] in ('scale', 'enlarge', 'resize') 
+                    for t in transforms):
+                fname = None
+            # art often shares files, which need only be defined once
+            source = (fname or key, size)
+            if size and source not in ids:
+                if fname:
+                    if embed:
+                        with open(fname, 'rb') as f:
+                            href = 'data:%s;base64,%s'%(
+                                mimetypes.guess_type(fname)[0] or 'image/png',
+                                base64.b64encode(f.read()))
+                    else:
+                        href = urljoin('file:', pathname2url(path.abspath(fname)))
+                else:
+                    data = StringIO()
+                    icons.getDerived(*key).save(data, 'PNG')
+                    href = 'data:image/png;base64,' + base64.b64encode(data.getvalue())
+                ids[source] = ('s%d'%len(images), size)
+                images.append('<image id="%s" width="%d" height="%d" '
+                    'preserveAspectRatio="none" xlink:href=%s/>'%(
+                    ids[source][0], size[0], size[1], quoteattr(href)))
+            defs[key] = size and ids[source]
+            return defs[key]
+            
+        body = []
+        def use(name, orientation, transforms, (x, y)):
+            sprite = define(name, orientation, transforms)
+            if sprite:
+                body.append('<use xlink:href="#%s" x="%d" y="%d"/>'%(sprite[0], x, y))
+        
+        with profiling.span('svg.background'):
+            body.append('<rect width="%d" height="%d" fill="%s"/>'%(
+                w, h, color(Board.background_color)))
+            sizes = [define(name, 1, scaling) for name in ['outline'] + self.rowStyles]
+            sizes = [sprite[1] for sprite in sizes if sprite]
+            if sizes:
+                size = (max(sw for (sw,sh) in sizes), max(sh for (sw,sh) in sizes))
+                geometry = self.geometry()
+                for (row, col) in geometry.overlapping((0, 0, w, h), size):
+                    xy = geometry.topLeft(row, col)
+                    use('outline', 1, scaling, xy)
+                    use(self.rowStyles[row], 1, scaling, xy)
+                
+        for (layer, ops) in groupby(displayList.ops, lambda op: op[1]):
+            if layer in skipLayers:
                 continue
+            with profiling.span('svg.' + (layer or 'scenario')):
+                for op in ops:
+                    if op[0] == 'sprite':
+                        (_, layer, name, orientation, transforms, x, y) = op
+                        use(name, orientation, transforms, (x, y))
+                    elif op[0] == 'label':
+                        # positioned by its baseline, where PIL uses the top
+                        (_, layer, text, size, x, y) = op
+                        font = icons.getFont(size)
+                        ascent = hasattr(font, 'getmetrics') and \
+                            font.getmetrics()[0] or size
+                        body.append('<text x="%d" y="%d" font-size="%d">%s</text>'%(
+                            x, y + ascent, size, escape(text)))
+                    elif op[0] == 'lines':
+                        dashes, width = self.flankDashes()
+                        body.append('<g stroke="%s" stroke-width="%d">'%(
+                            color(Board.dash_color), width))
+                        body += ['<line x1="%d" y1="%d" x2="%d" y2="%d"/>'%(
+                            x0, y0, x1, y1) for ((x0, y0), (x1, y1)) in dashes]
+                        body.append('</g>')
+        
+        # the board is clipped to its size and framed by the border
+        return u'\n'.join([
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<svg xmlns="http://www.w3.org/2000/svg" '
+                'xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1" '
+                'width="%gin" height="%gin" viewBox="0 0 %d %d">'%(
+                float(W) / dpi, float(H) / dpi, W, H),
+            '<defs>',
+            '<clipPath id="board"><rect width="%d" height="%d"/></clipPath>'%(w, h)]
+            + images + [
+            '</defs>',
+            '<g transform="translate(%d,%d)">'%(bw, bw),
+            '<g clip-path="url(#board)" font-family="Verdana" font-weight="bold">']
+            + body + [
+            '</g>',
+            '</g>',
+            '<rect x="%g" y="%g" width="%d" height="%d" fill="none" '
+                'stroke="%s" stroke-width="%d"/>'%(bw / 2., bw / 2., W - bw, 
+                H - bw, color(Board.border_color), bw),
+            '</svg>', '']).encode('utf-8')
+        
+    # compile the medals, title and overlay layers into a display list of 
+    # sprites and labels positioned on the board, in painting order.  By 
+    # default all layers are compiled, so the list can be replayed with any
+    # of them skipped.  See setResolution for hexWidth and dpi
+    def compile(self, icons, hexWidth = 2.0866, dpi = None, layers = None):
+        dpi = self.setResolution(hexWidth, dpi)
+        scale = self.scale
+        geometry = self.geometry()
+        fontSize = Board.scaled(32, scale)
+        scaling = (('scale', scale),) if scale != 1 else ()
+        if layers is None:
+            layers = Board.drawing_layers
+        ops = []
+        
+        def sprite(layer, name, orientation, transforms, xy):
+            ops.append(('sprite', layer, name, orientation, transforms) + tuple(xy))
             
-            for col in xrange(self.cols - (row%2)): # skip last hex on odd rows
-                xy = Board.coords(row,col)
-                if outline: board.paste(outline, tuple(xy), outline)
-                board.paste(image, tuple(xy), image)
+        def label(layer, text, xy):
+            ops.append(('label', layer, text, fontSize) + tuple(xy))
 
-        # medal1 - Allies Medal
-        # medal2 - German Medal
-        # <note there isn't a medal3>
-        # medal4 - Victoria Cross
-        # medal5 - Italian Medal of Valor
-        # medal6 - Hero of the Soviet Union Medal
-        # medal7 - Order of the Golden Kite Medal
-		medal_dict = {
-		    # Default axis / allies medals in side_player[1|2] value
-		    'ALLIES' : 1, 'AXIS' : 2, 
-		    # Country-specific medals, coded in country_player[1|2] value
-		    'US' : 1, 'DE' : 2, 'GB' : 4, 'IT' : 5, 'RU' : 6, 'JP' : 7
-		}
-		
         # paint the victory medals, with player1 at the top (flipped)
         # and player2 at the bottom.
         for p in ['1','2']:
             vp = self.game_info.get('victory_player' + p, 6)
+            medal_name = self.medalName(p)
             
-            side = self.game_info.get('side_player' + p, '')
-            country = self.game_info.get('country_player' + p, '')
-            
-            medal_num = medal_dict.get(country, None)
-            if not medal_num:
-                medal_num = medal_dict.get(side, None)
-                
-            medal_name = 'medal' + (medal_num and `medal_num`) or p
-            
-            medal = icons.getImage(medal_name)
+            # trim the medal, and enlarge it
+            transforms = [('trim',), ('enlarge', 1.5)]
+            if p == '1':    # Draw top medals upside facing board edge
+                transforms.insert(1, ('flip',))
+            transforms = scaling + tuple(transforms)
+            medal = icons.getDerived(medal_name, 1, transforms)
             if not medal:
-                logging.warn("Couldn't find victory marker image %s"%name)
+                logging.warn("Couldn't find victory marker image %s"%medal_name)
                 continue
                 
-            medal = medal.crop(medal.getbbox())
-            if p == '1':    # Draw top medals upside facing board edge
-                medal = ImageOps.flip(medal)
-            medal = medal.resize((XY(*medal.size) * 1.5).ints(),Image.ANTIALIAS)
             mxy = XY(*medal.size)
             for col in xrange(self.cols-vp,self.cols):
-                xy = Board.coords(0, col) - mxy.doti((1/2.,3/4.))
+                xy = geometry.topLeft(0, col) - mxy.doti((1/2.,3/4.))
                 if p == '2':    # Position bottom medals by reflection
-                    xy = - xy - mxy + board.size
-                board.paste(medal,tuple(xy),medal)
+                    xy = - xy - mxy + self.size()
+                sprite(None, medal_name, 1, transforms, xy)
 
         # label the scenario
-        canvas.text(Board.marginXY.doti( (1/2., 1/3.) ),
-            self.text['name'], fill = 'black', font=font)
+        label(None, self.text['name'], 
+            Board.scaled(Board.marginXY, scale).doti( (1/2., 1/3.) ))
         
         # warn about layers we won't deal with
         for hexagon in self.info['labels'] + self.info['hexagons']:
@@ -313,116 +1019,557 @@ class Board:
                     
         # now paint on the overlay elements
         for key in Board.drawing_layers:
-            if key in skipLayers:
+            if key not in layers:
                 continue            # skipping this layer?
                 
-            if key is 'lines':      # placeholder for flank lines
-                col = 0
-                while col < self.cols:
-                    for inc in [4,5,4]:
-                       col += inc
-                       if col >= self.cols:
-                           break
-                           
-                       # Find starting point of dashed flank line
-                       (x,y1) = Board.coords(0,col)
-                       x -= Board.dash_width / 2 - 2
-                       y1 += Board.hexXY.y/4
-                       # Find ending point
-                       y2 = Board.coords(self.rows,0).y
-                       
-                       # Draw the dashed line
-                       y = y1
-                       while y < y2:
-                           ye = min(y2, y+Board.dash_length[0])
-                           canvas.line([(x,y),(x,ye)], 
-                               fill=Board.dash_color, width=Board.dash_width) 
-                           y += sum(Board.dash_length)
-                           
-                continue            # on to next layer
+            with profiling.span('compile.' + key):
+                if key is 'lines':      # placeholder for flank lines
+                    ops.append(('lines', key))
+                    continue            # on to next layer
                 
-            hexagons = self.info['labels' if key is 'text' else 'hexagons']
-            for hexagon in hexagons:
-                col,row = hexagon['col'],hexagon['row']
+                hexagons = self.info['labels' if key is 'text' else 'hexagons']
+                for hexagon in hexagons:
+                    col,row = hexagon['col'],hexagon['row']
 
-                content = hexagon.get(key,None)
-                if not content: continue
+                    content = hexagon.get(key,None)
+                    if not content: continue
                 
-                # make everything a list for simplicity
-                if type(content) is not ListType:
-                    contents = [content]
-                else:
-                    contents = content
+                    # make everything a list for simplicity
+                    if type(content) is not ListType:
+                        contents = [content]
+                    else:
+                        contents = content
 
-                xy = Board.coords2(row,col)
+                    xy = geometry.topLeft2(row, col)
                 
-                if key is 'text':
-                    for (i,content) in enumerate(contents):
-                        wh = XY(*canvas.textsize(content, font=font))
-                        pos = xy + Board.hexXY.doti( (1/2., 3/4.) ) \
-                            - wh.doti( (1/2., 1.1*(len(contents)/2. - i)) )
-                        canvas.text(pos, content, fill="black", font=font)
+                    if key is 'text':
+                        for (i,content) in enumerate(contents):
+                            (mask, wh) = icons.getLabel(content, fontSize)
+                            pos = xy + Board.scaled(Board.hexXY, scale).doti( (1/2., 3/4.) ) \
+                                - wh.doti( (1/2., 1.1*(len(contents)/2. - i)) )
+                            label(key, content, pos)
                         
-                    continue            # on to next hex
+                        continue            # on to next hex
                 
-                # sort contents by name to get consistent order for tags
-                contents.sort(key = lambda c: c['name'])
-                for i,content in enumerate(contents):
-                    name = content['name']
-                    image = icons.getImage(name, content.get('orientation',1))
-                    if not image:
-                        logging.warn("(col=%d, row=%d): No image for %s"%(
-                            col,row,name))
-                        continue
+                    # sort contents by name to get consistent order for tags
+                    contents.sort(key = lambda c: c['name'])
+                    for i,content in enumerate(contents):
+                        name = content['name']
+                        orientation = content.get('orientation',1) or 1
+                        image = icons.getImage(name, orientation, scale)
+                        if not image:
+                            logging.warn("(col=%d, row=%d): No image for %s"%(
+                                col,row,name))
+                            continue
                     
-                    # hack to deal with multiple medal tags in a single hex
-                    # but won't work for things like 'battle stars' (named "tag1")
-                    # which is already centered in lower right
-                    if i > 0:
-                        offset = Board.tagOffset.dot(
-                            [(1,1),(-1,-1),(-1,1),(1,-1)][i%4]) - Board.tagOffset
-                        logging.debug("%s:%d:%s at (col=%d, row=%d) - offset by %s"%(
-                            key,i,name, col, row, `offset`))
-                        xy = xy + offset
-                        if key is not 'tags':
-                            logging.warn(
-"Didn't expect multiple instances of [%s] at (col=%d, row=%d)"%(key, col, row))
-                        elif i > 3:
-                            logging.warn(
-"Can't deal with more than four tags at (col=%d, row=%d)"%(col,row))
+                        # hack to deal with multiple medal tags in a single hex
+                        # but won't work for things like 'battle stars' (named "tag1")
+                        # which is already centered in lower right
+                        if i > 0:
+                            tagOffset = Board.scaled(Board.tagOffset, scale)
+                            offset = tagOffset.dot(
+                                [(1,1),(-1,-1),(-1,1),(1,-1)][i%4]) - tagOffset
+                            logging.debug("%s:%d:%s at (col=%d, row=%d) - offset by %s"%(
+                                key,i,name, col, row, `offset`))
+                            xy = xy + offset
+                            if key is not 'tags':
+                                logging.warn(
+    "Didn't expect multiple instances of [%s] at (col=%d, row=%d)"%(key, col, row))
+                            elif i > 3:
+                                logging.warn(
+    "Can't deal with more than four tags at (col=%d, row=%d)"%(col,row))
                         
                             
-                    board.paste(image,tuple(xy),image)
+                        sprite(key, name, orientation, scaling, xy)
                     
-                    if i > 0: 
-                        # center of medal tag is top-right, about XY(133,66),
-                        #, i.e about +39, -42 from center of hex XY(188,217)
-                        # for subsequent ones, move them around the hex 
-                        # to bottom-left, bottom-right, top-left?
-                        logging.debug('(col=%d,row=%d), name=%s, item #=%d'%(
-                            col,row,name,i))
+                        if i > 0: 
+                            # center of medal tag is top-right, about XY(133,66),
+                            #, i.e about +39, -42 from center of hex XY(188,217)
+                            # for subsequent ones, move them around the hex 
+                            # to bottom-left, bottom-right, top-left?
+                            logging.debug('(col=%d,row=%d), name=%s, item #=%d'%(
+                                col,row,name,i))
                     
-                    # handle nbr_units and badge attributes within unit layer
-                    if content.has_key('badge'):    # unit badges
-                        # badges are not padded to hex size, and too small
-                        # so resize and center on unit top left corner
-                        image = icons.getImage(content['badge'])
-                        image = image.resize(Board.badgeSize,Image.ANTIALIAS)
-                        if image:
-                            pos = xy + Board.unitTL - Board.badgeSize / 2
-                            board.paste(image, tuple(pos), image)
+                        # handle nbr_units and badge attributes within unit layer
+                        if content.has_key('badge'):    # unit badges
+                            # badges are not padded to hex size, and too small
+                            # so resize and center on unit top left corner
+                            badgeSize = Board.scaled(Board.badgeSize, scale)
+                            transforms = (('resize', tuple(badgeSize)),)
+                            if icons.getDerived(content['badge'], 1, transforms):
+                                pos = xy + Board.scaled(Board.unitTL, scale) - badgeSize / 2
+                                sprite(key, content['badge'], 1, transforms, pos)
                             
-                    if content.has_key('nbr_units'):
-                        image = icons.getImage('nbr_units', int(content['nbr_units']))
-                        if image:
-                            board.paste(image, tuple(xy), image)
-              
-        board = ImageOps.expand(
-            board, border=Board.border_width, fill=Board.border_color)
-        board.info['dpi'] = (dpi,dpi)
+                        if content.has_key('nbr_units'):
+                            n = int(content['nbr_units'])
+                            if icons.getImage('nbr_units', n, scale):
+                                sprite(key, 'nbr_units', n, scaling, xy)
+                            
+        return DisplayList(self.format, self.face, scale, dpi, layers, ops)
         
+# a board compiled to a flat list of painting operations (see Board.compile)
+# which can be replayed quickly, e.g. to render the same scenario for other
+# page sizes or with some layers skipped.  Each operation is one of
+#   ('sprite', layer, name, orientation, transforms, x, y)
+#   ('label', layer, text, fontSize, x, y)
+#   ('lines', 'lines')
+# where layer is None for the medals and title, which are always drawn.
+# The list can be saved as JSON, with a source string (e.g. a digest of 
+# the scenario and render options) to tell whether it is still valid
+class DisplayList:
+    version = 1         # bump if the saved format changes
+    
+    def __init__(self, format, face, scale, dpi, layers, ops, source = None):
+        self.format = format
+        self.face = face
+        self.scale = scale
+        self.dpi = dpi
+        self.layers = list(layers)
+        self.ops = ops
+        self.source = source
+        
+    # a board of the same format and face, without any scenario details,
+    # which can paint the background and replay the list
+    def board(self):
+        board = Board({ 
+            'board' : { 'type' : self.format, 'face' : self.face, 
+                'hexagons' : [], 'labels' : [] },
+            'game_info' : {} })
+        board.scale = self.scale
         return board
         
+    # the (left, upper, right, lower) box of the board painted by an
+    # operation, or None for the flank lines, which cover the whole board
+    def bounds(self, icons, op):
+        if op[0] == 'sprite':
+            (x, y) = op[5:]
+            (w, h) = icons.getDerived(op[2], op[3], op[4]).size
+        elif op[0] == 'label':
+            (x, y) = op[4:]
+            (w, h) = icons.getLabel(op[2], op[3])[1]
+        else:
+            return None
+        return (x, y, x + w, y + h)
+        
+    # the boxes of the board that must be repainted to turn a rendering of
+    # previous into this list, ignoring operations in skipLayers.  Returns
+    # None if the whole board has to be repainted
+    def changedRegions(self, icons, previous, skipLayers = []):
+        if (self.format, self.face, self.scale, self.dpi) != \
+                (previous.format, previous.face, previous.scale, previous.dpi):
+            return None
+        ops = [op for op in self.ops if op[1] not in skipLayers]
+        previousOps = [op for op in previous.ops if op[1] not in skipLayers]
+        
+        changed = (Counter(ops) - Counter(previousOps)) + \
+            (Counter(previousOps) - Counter(ops))
+        # the painting order of everything else must be the same too
+        if [op for op in ops if op not in changed] != \
+                [op for op in previousOps if op not in changed]:
+            return None
+        
+        regions = []
+        for op in changed:
+            box = self.bounds(icons, op)
+            if box is None:
+                return None
+            regions.append(box)
+        return regions
+        
+    def save(self, fname):
+        with open(fname, 'w') as f:
+            json.dump({ 'version' : DisplayList.version, 'format' : self.format, 
+                'face' : self.face, 'scale' : self.scale, 'dpi' : self.dpi, 
+                'layers' : self.layers, 'source' : self.source, 
+                'ops' : self.ops }, f)
+                
+    # load a saved display list, returning None if it is missing or unreadable
+    @staticmethod
+    def load(fname):
+        try:
+            with open(fname) as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if saved.get('version') != DisplayList.version:
+            return None
+            
+        # JSON turns our tuples into lists, but images are cached by transform
+        def frozen(value):
+            if isinstance(value, list):
+                return tuple(frozen(v) for v in value)
+            return value
+        ops = [tuple(op[:4]) + (frozen(op[4]),) + tuple(op[5:]) 
+                if op[0] == 'sprite' else tuple(op) for op in saved['ops']]
+        return DisplayList(saved['format'], saved['face'], saved['scale'],
+            saved['dpi'], saved['layers'], ops, saved['source'])
+
+# a stand-in for a rendered board image, which splitimage can tile without
+# the full board ever being in memory: each cropped page is rendered on demand
+class BoardRegions:
+    def __init__(self, board, icons, displayList, skipLayers = []):
+        self.board = board
+        self.icons = icons
+        self.displayList = displayList
+        self.skipLayers = skipLayers
+        board.scale = displayList.scale
+        self.size = tuple(board.size() + XY(2,2) * Board.border_width)
+        self.info = { 'dpi' : (displayList.dpi,)*2 }
+        
+    def crop(self, box):
+        return self.board.renderRegion(self.icons, self.displayList, box, 
+            self.skipLayers)
+    
+    def save(self, fname, **kwargs):
+        self.board.renderDisplayList(self.icons, self.displayList, 
+            self.skipLayers).save(fname, **kwargs)
+
+# the contents of a scenario given as a file name, its JSON text or the
+# parsed dictionary
+def readScenario(scenario):
+    if isinstance(scenario, dict):
+        return json.dumps(scenario, sort_keys=True)
+    if isinstance(scenario, unicode):
+        scenario = scenario.encode('utf-8')
+    if scenario.lstrip().startswith('{'):
+        return scenario
+    with open(scenario, 'rb') as f:
+        return f.read()
+
+# render a single scenario (a file, or see readScenario) with the given 
+# library, and save the (possibly tiled) result, returning the list of 
+# files written.  With several hex widths (args.hexwidth is a list), each
+# is saved as output_base-<width>in.  Boards for different hex widths only 
+# differ in their DPI (unless rendered at a dpi target), so are rendered 
+# once, and the pages for every hex width and page size are saved at the
+# same time.
+# With args.svg, an SVG document output_base.svg is saved instead of pages.
+# With args.output_cache, files saved from an earlier render of the same
+# scenario, options and art are reused instead.
+# With files (a dictionary), nothing is written to disk, and instead the
+# contents of each file are stored in files by name (without the cache)
+def renderScenario(icons, scenario_file, output_base, args, files = None):
+    cache = files is None and getOutputCache(icons, args)
+    if cache:
+        key = outputKey(icons, scenario_file, args)
+        outputs = cache.lookup(key, output_base)
+        if outputs is not None:
+            return outputs
+            
+    hexWidths = args.hexwidth
+    groups = []         # (display list, [(output base, dpi)]) for each render
+    for hexWidth in hexWidths:
+        displayList = compileScenario(icons, scenario_file, args, hexWidth)
+        output = (output_base + ('-%gin'%hexWidth if len(hexWidths) > 1 else ''),
+            displayList.dpi)
+        for (other, outputs) in groups:
+            if other.scale == displayList.scale and other.ops == displayList.ops:
+                outputs.append(output)
+                break
+        else:
+            groups.append((displayList, [output]))
+    
+    results = []
+    for (displayList, outputs) in groups:
+        svg = getattr(args, 'svg', None)
+        if svg:
+            for (basename, dpi) in outputs:
+                with profiling.span('board.svg'):
+                    document = displayList.board().renderSVG(icons, displayList, 
+                        args.xlayers, dpi, embed = svg == 'embed')
+                fname = basename + '.svg'
+                if files is None:
+                    splitimage.removeOld(fname)
+                    with open(fname, 'wb') as f:
+                        f.write(document)
+                else:
+                    files[fname] = document
+                results.append(fname)
+            continue
+        if getattr(args, 'stream', False):
+            image = BoardRegions(displayList.board(), icons, displayList, args.xlayers)
+        else:
+            image = renderBoard(icons, displayList, args)
+        with profiling.span('tiles'):
+            results += splitimage.concurrently(
+                lambda (basename, dpi): splitimage.saveTiledImagesArgs(image, 
+                    basename, args, dpi=dpi, files=files), outputs)
+    if cache:
+        cache.store(key, output_base, results)
+    return results
+    
+# render a compiled board with args, on args.bands processes if there are 
+# several (and this isn't already a worker process)
+def renderBoard(icons, displayList, args):
+    bands = getattr(args, 'bands', 1)
+    if bands > 1 and not current_process().daemon:
+        # worker processes (like our batch renderers) can't start their own
+        renderer = BandRenderer(icons, bands)
+        try:
+            with profiling.span('board.render', bands=bands):
+                return renderer.render(displayList, args.xlayers)
+        finally:
+            renderer.close()
+    with profiling.span('board.render'):
+        return displayList.board().renderDisplayList(icons, displayList, args.xlayers)
+        
+# the library API, for programs rendering boards in memory rather than from
+# and to files.  scenario is the contents of a .m44 file or the parsed 
+# dictionary, icons is an ArtLibrary (see openArtLibrary), which threads
+# can share to render at once, and args are the options from renderOptions.
+# renderImage returns the whole board as an image (at the first hex width),
+# and renderPages returns the files the command line would save, as a list
+# of (file name, contents), named from basename like board0101.png
+def renderImage(icons, scenario, args = None):
+    args = args or renderOptions()
+    return renderBoard(icons, compileScenario(icons, scenario, args), args)
+    
+def renderPages(icons, scenario, args = None, basename = 'board'):
+    files = {}
+    names = renderScenario(icons, scenario, basename, args or renderOptions(), 
+        files)
+    return [(name, files[name]) for name in names]
+    
+# the arguments for the library API, with the defaults of the command line
+# except for options given by name, like renderOptions(page_size=['a4'],
+# dpi_target=300).  Raises TypeError for unknown options
+def renderOptions(**options):
+    args = setupArgParser().parse_args([])
+    for (name, value) in options.items():
+        if not hasattr(args, name):
+            raise TypeError("unknown option %s"%name)
+        # a single value for options which take a list
+        if isinstance(getattr(args, name), list) and \
+                not isinstance(value, (list, tuple)):
+            value = [value]
+        setattr(args, name, value)
+    return args
+
+# options which change the files renderScenario writes
+output_options = ['xlayers', 'hexwidth', 'dpi_target', 'page_size', 'margin',
+    'overlap', 'nomarks', 'dpi', 'encoder', 'pyramid', 'svg']
+    
+# the output cache for args, if they ask for one.  There is one cache object
+# per process, so that its hits and misses add up across scenarios
+output_caches = {}
+
+def getOutputCache(icons, args):
+    if not getattr(args, 'output_cache', False):
+        return None
+    folder = path.join(getCacheDir(icons.imageDir), 'outputs')
+    if folder not in output_caches:
+        output_caches[folder] = OutputCache(folder, args.output_cache_mb * 2**20)
+    return output_caches[folder]
+    
+# the output cache key for rendering a scenario file with args, from the
+# scenario, the options that change the output, a fingerprint of the art 
+# files it uses and a digest of the code that draws it
+def outputKey(icons, scenario_file, args):
+    scenario = readScenario(scenario_file)
+    board = Board(scenario)
+    options = dict((name, getattr(args, name, None)) for name in output_options)
+    return OutputCache.key(scenario, options, 
+        icons.fingerprint(board.artNames(args.xlayers)), codeDigest())
+
+# a digest of the source of the modules that draw and save boards
+code_digest = None
+
+def codeDigest():
+    global code_digest
+    if code_digest is None:
+        digest = hashlib.sha1()
+        for name in [__name__, 'splitimage', 'geometry', 'xy']:
+            with open(path.splitext(sys.modules[name].__file__)[0] + '.py', 'rb') as f:
+                digest.update(f.read())
+        code_digest = digest.hexdigest()
+    return code_digest
+
+# compile a scenario (a file, or see readScenario) to a display list for 
+# hexWidth (by default the first of args.hexwidth) and the dpi in args.
+# With args.display_list, a list saved there for the same scenario and 
+# options is reused, and otherwise the list is compiled with every layer 
+# and saved
+def compileScenario(icons, scenario_file, args, hexWidth = None):
+    hexWidth = hexWidth or args.hexwidth[0]
+    fname = getattr(args, 'display_list', None)
+    scenario = readScenario(scenario_file)
+    source = '%s:%r:%r'%(hashlib.sha1(scenario).hexdigest(), 
+        hexWidth, args.dpi_target)
+    if fname:
+        with profiling.span('scenario.load'):
+            displayList = DisplayList.load(fname)
+        if displayList and displayList.source == source:
+            logging.info("Using display list %s"%fname)
+            return displayList
+            
+    with profiling.span('scenario.parse'):
+        board = Board(scenario)
+    skipLayers = [] if fname else args.xlayers
+    icons.prefetch(board.artNames(skipLayers))
+    with profiling.span('scenario.compile'):
+        displayList = board.compile(icons, hexWidth, args.dpi_target, 
+            [key for key in Board.drawing_layers if key not in skipLayers])
+    displayList.source = source
+    if fname:
+        displayList.save(fname)
+    return displayList
+
+# re-renders a scenario whenever its file changes, e.g. while it is being
+# edited.  The art library, display list and rendered board are kept from 
+# one render to the next, so only the parts of the board whose sprites or
+# labels changed are repainted, and only the pages they touch are rewritten
+class ScenarioWatcher:
+    def __init__(self, icons, scenario_file, output_base, args):
+        self.icons = icons
+        self.scenario_file = scenario_file
+        self.output_base = output_base
+        self.args = args
+        self.stamp = None           # (mtime, size) of the file last rendered
+        self.displayList = None
+        self.board = None
+        self.image = None
+        
+    # render the scenario if its file has changed since last time, 
+    # returning the list of files written
+    def update(self):
+        try:
+            st = os.stat(self.scenario_file)
+        except OSError:
+            return []
+        stamp = (st.st_mtime, st.st_size)
+        if stamp == self.stamp:
+            return []
+        self.stamp = stamp
+        
+        try:
+            displayList = compileScenario(self.icons, self.scenario_file, self.args)
+        except (IOError, ValueError, KeyError), e:     # e.g. half-written file
+            logging.warn("Couldn't read %s: %s"%(self.scenario_file, e))
+            return []
+            
+        skipLayers = self.args.xlayers
+        regions = None
+        if self.displayList:
+            regions = displayList.changedRegions(self.icons, self.displayList, 
+                skipLayers)
+        self.displayList = displayList
+        
+        if regions is None:
+            self.board = displayList.board()
+            self.image = self.board.renderDisplayList(self.icons, displayList,
+                skipLayers)
+        else:
+            # repaint each changed box, in the coordinates of the bordered image
+            bw = Board.border_width
+            (w, h) = self.image.size
+            regions = [(max(0, x0 + bw), max(0, y0 + bw), 
+                    min(w, x1 + bw), min(h, y1 + bw)) 
+                for (x0, y0, x1, y1) in regions]
+            regions = [box for box in regions if box[0] < box[2] and box[1] < box[3]]
+            if not regions:
+                return []
+            for box in regions:
+                self.image.paste(self.board.renderRegion(self.icons, displayList, 
+                    box, skipLayers), box[:2])
+        
+        return splitimage.saveTiledImagesArgs(self.image, self.output_base, 
+            self.args, regions=regions)
+        
+    # poll for changes every interval seconds until interrupted
+    def run(self, interval = 0.5):
+        print "Watching %s for changes, press Ctrl-C to stop"%self.scenario_file
+        while True:
+            start = time.time()
+            outputs = self.update()
+            if outputs:
+                print "Wrote %d image(s) in %.2fs"%(len(outputs), time.time() - start)
+            time.sleep(interval)
+        
+# each batch (or band) worker process keeps its own reference to the shared
+# art library (built once by the parent), so images it loads are reused 
+# across scenarios
+batch_icons = None
+
+def initBatchWorker(icons):
+    global batch_icons
+    batch_icons = icons
+
+def renderBatchItem((scenario_file, args)):
+    cache = getOutputCache(batch_icons, args)
+    hits = cache and cache.hits
+    try:
+        outputs = renderScenario(batch_icons, scenario_file, 
+            path.splitext(scenario_file)[0], args)
+    except Exception, e:
+        return (scenario_file, False, '%s: %s'%(e.__class__.__name__, e))
+    cached = cache and cache.hits > hits
+    return (scenario_file, True, '%d image(s)%s'%(len(outputs), 
+        cached and ' from cache' or ''))
+
+# render every scenario file in a folder on a pool of worker processes,
+# writing outputs alongside each scenario.  Returns a list of 
+# (scenario_file, ok, message) tuples in scenario order
+def renderBatch(icons, folder, args, jobs = None):
+    scenarios = sorted(glob(path.join(folder, '*.m44')))
+    if not scenarios:
+        logging.warn("No scenario files found in %s"%folder)
+        return []
+        
+    jobs = min(jobs or cpu_count(), len(scenarios))
+    pool = Pool(jobs, initBatchWorker, (icons,))
+    try:
+        results = []
+        for result in pool.imap_unordered(renderBatchItem, 
+                [(s, args) for s in scenarios]):
+            print "%s: %s (%s)"%(
+                result[1] and 'OK' or 'FAILED', result[0], result[2])
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+    
+    results.sort()
+    failures = [r for r in results if not r[1]]
+    print "Rendered %d of %d scenarios with %d process(es)"%(
+        len(results) - len(failures), len(results), jobs)
+    if getattr(args, 'output_cache', False):
+        print "Reused %d scenario(s) from the output cache"%len([r for r in results
+            if r[2].endswith(' from cache')])
+    for (scenario_file, ok, message) in failures:
+        print "  FAILED: %s (%s)"%(scenario_file, message)
+    return results
+        
+# renders whole boards on a pool of worker processes, one horizontal band
+# each.  A band only paints the background hexes, sprites and labels that
+# touch it (see renderRegion), in the usual order, so the stitched image is
+# identical to renderDisplayList's.  Bands paint their own background
+# rather than each worker loading the whole board's plate
+class BandRenderer:
+    def __init__(self, icons, bands = None):
+        self.bands = bands or cpu_count()
+        self.pool = Pool(self.bands, initBatchWorker, (icons,))
+        
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        
+    def render(self, displayList, skipLayers = []):
+        board = displayList.board()
+        (w, h) = board.size() + XY(2,2) * Board.border_width
+        n = min(self.bands, h)
+        boxes = [(0, h * i / n, w, h * (i + 1) / n) for i in xrange(n)]
+        image = Image.new('RGB', (w, h))
+        for (box, band) in zip(boxes, self.pool.imap(renderBand,
+                [(displayList, box, skipLayers) for box in boxes])):
+            image.paste(band, box[:2])
+        image.info['dpi'] = (displayList.dpi,)*2
+        return image
+        
+def renderBand((displayList, box, skipLayers)):
+    with profiling.span('board.band', box=box):
+        return displayList.board().renderRegion(batch_icons, displayList, box, 
+            skipLayers)
+        
 def setupArgParser():
     
     # validate argument value containing comma-separated list of strings
@@ -438,62 +1585,142 @@ def setupArgParser():
             
             return values
         return checkList
+        
+    # comma-separated list of numbers
+    def floatList(value):
+        try:
+            return [float(v) for v in value.split(',')]
+        except ValueError:
+            raise ArgumentTypeError('invalid number list: %s'%value)
      
     parser = ArgumentParser(
         description = "Render a Memoir 44 scenario file for multi-page printing")
-    parser.add_argument('scenario_file', 
+    parser.add_argument('scenario_file', nargs='?',
         metavar='scenario.m44', help='The M44 scenario to render')
     parser.add_argument('output_base', nargs='?',
         metavar='outputbase.png', help='The canonical path for output image(s)')
     parser.add_argument('-a','--appdir', default=None,
         help='Pathname of the Memoir 44 Editor folder')
-    parser.add_argument('-w','--hexwidth', type=float, default=2.0866,
-        help="Hex width in inches across the flats")
+    parser.add_argument('-w','--hexwidth', type=floatList, default=[2.0866],
+        metavar='2.0866,3', help="Hex width(s) in inches across the flats")
+    parser.add_argument('--dpi-target', dest='dpi_target', type=int, default=None,
+        help="Render directly at this resolution, scaling the art to match the hex width")
+    parser.add_argument('--stream', action='store_true', default=False,
+        help="Render each page separately rather than the whole board, to save memory")
+    parser.add_argument('--bands', type=int, default=1,
+        help="Render the board in this many horizontal bands on as many processes")
+    parser.add_argument('--svg', default=None, choices=['link', 'embed'],
+        help="Save the board as an SVG document which links to (or embeds) the art, instead of pages")
     layer_opts = Board.drawing_layers + ['none']
     parser.add_argument('-x','--xlayers', 
         type=choiceList(choices = layer_opts),
         metavar=','.join(layer_opts),
         default=['obstacle','unit'],
         help="Comma-separated list of drawing layers to skip")
+    parser.add_argument('--display-list', dest='display_list', default=None, 
+        metavar='file.json', help="Reuse the compiled scenario saved in this file, or save it there")
+    parser.add_argument('--watch', action='store_true', default=False,
+        help="Keep running, and update the images whenever the scenario file changes")
+    parser.add_argument('--profile', default=None, metavar='profile.json',
+        help="Save timings of each phase and cache hits and misses to this file")
+    parser.add_argument('--profile-trace', dest='profile_trace', default=None,
+        metavar='trace.json', help="Save the timings as a Chrome trace (see chrome://tracing)")
+    parser.add_argument('--art-cache-mb', dest='art_cache_mb', type=int, default=512,
+        help="Memory in MB for decoded art, beyond which the least recently used is dropped")
+    parser.add_argument('--build-atlas', dest='build_atlas', action='store_true', 
+        default=False, help="Pack all downloaded art into a fast-loading atlas and exit")
+    parser.add_argument('--output-cache', dest='output_cache', action='store_true',
+        default=False, help="Reuse the images from an earlier render of the same "
+            "scenario, options and art, and save new ones for next time")
+    parser.add_argument('--output-cache-mb', dest='output_cache_mb', type=int, 
+        default=1024, help="Size in MB the output cache is trimmed to (default 1024)")
+    parser.add_argument('-b','--batch', default=None, metavar='folder',
+        help="Render every .m44 scenario in a folder instead of a single file")
+    parser.add_argument('-j','--jobs', type=int, default=None,
+        help="Number of worker processes for batch rendering (default: one per CPU)")
     
     parser = splitimage.setupArgParser(parser)
     
     return parser
     
+# the art library for the Memoir '44 Editor in appdir (or a standard location),
+# or None if the editor can't be found.  Missing art is downloaded from 
+# imageURL, unless that is None
+def openArtLibrary(appdir = None, imageURL = base_url, cacheBytes = 512 * 2**20):
+    folders = app_dirs
+    if appdir:
+        if not path.exists(appdir) and not path.exists(appdir + '.app'):
+            logging.warn("Can't find specified appdir: %s"%appdir)
+        else:
+            if path.isfile(appdir):
+                appdir = path.dirname(appdir)
+            folders = [appdir] + app_dirs
+          
+    sed_data_xml = findSedData(folders)
+    if not sed_data_xml:
+        logging.error("Can't find Memoir '44 Editor resource data, sorry")
+        return None
+        
+    return ArtLibrary([sed_data_xml, findBgData()], getImageDir(), imageURL,
+        cacheBytes = cacheBytes)
+    
+# save the timings recorded by a profiler as requested by --profile and
+# --profile-trace
+def saveProfile(profiler, args):
+    if args.profile:
+        profiler.save(args.profile)
+    if args.profile_trace:
+        profiler.saveTrace(args.profile_trace)
+    
 ########################################
 
 if __name__ == "__main__":
     args = setupArgParser().parse_args()
     
-    if args.appdir:
-        if not path.exists(args.appdir) and not path.exists(args.appdir + '.app'):
-            logging.warn("Can't find specified appdir: %s"%args.appdir)
-        else:
-            if path.isfile(args.appdir):
-                args.appdir = path.dirname(args.appdir)
-            app_dirs = [args.appdir] + app_dirs
-          
-    sed_data_xml = findSedData(app_dirs)
-    if not sed_data_xml:
-        logging.error("Can't find Memoir '44 Editor resource data, sorry")
-        sys.exit(-1)
+    if args.profile or args.profile_trace:
+        # saved on exit, however we finish
+        atexit.register(saveProfile, profiling.start(), args)
     
-    if not path.exists(args.scenario_file):
+    if args.build_atlas:
+        pass
+    elif args.batch:
+        if not path.isdir(args.batch):
+            logging.error("Can't find scenario folder %s"%args.batch)
+            sys.exit(-1)
+    elif not args.scenario_file or not path.exists(args.scenario_file):
         logging.error("Can't find scenario file %s"%args.scenario_file)
         sys.exit(-1)
     
+    # read the foreground hex (and other tiles and counters) image dictionaries
+    icons = openArtLibrary(args.appdir, cacheBytes = args.art_cache_mb * 2**20)
+    if not icons:
+        sys.exit(-1)
+
+    if args.build_atlas:
+        print "Packed %d images into %s"%(icons.buildAtlas(), icons.atlasFile)
+        sys.exit(0)
+        
+    if args.batch:
+        results = renderBatch(icons, args.batch, args, args.jobs)
+        sys.exit(0 if all(r[1] for r in results) else -2)
+        
     # output to basename (excluding extension), based on scenario file if not given
     if not args.output_base:
         args.output_base = args.scenario_file
     args.output_base = path.splitext(args.output_base)[0]
         
-    # read the foreground hex (and other tiles and counters) image dictionaries
-    icons = ArtLibrary([sed_data_xml, findBgData()], getImageDir(), base_url)
-
-    # create the board
-    board = Board(args.scenario_file)
-    # render the image
-    image = board.render(icons, skipLayers=args.xlayers, hexWidth=args.hexwidth)
-    # save the tiled versions
-    splitimage.saveTiledImagesArgs(image, args.output_base, args)
+    if args.watch:
+        if len(args.hexwidth) > 1 or len(args.page_size) > 1 or args.svg:
+            logging.error("--watch takes a single hex width and page size, without --svg")
+            sys.exit(-1)
+        try:
+            ScenarioWatcher(icons, args.scenario_file, args.output_base, args).run()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+        
+    # render the board and save the tiled versions
+    renderScenario(icons, args.scenario_file, args.output_base, args)
+    if args.output_cache:
+        print getOutputCache(icons, args).report()
 
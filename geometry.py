@@ -0,0 +1,122 @@
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+from xy import XY
+
+# the pixel positions of the hexes on a board of cols x rows hexes, where
+# tiles are tileXY pixels and topLeft(row, col) gives the top-left corner
+# of the tile in row, col (counting hexes along the row).  Positions are
+# computed once into tables, which also answer which hexes overlap part of
+# the board and which hex (if any) contains a pixel.  Use HexGeometry.get
+# to share the tables for each board format and scale
+class HexGeometry:
+    # cached geometries, by (cols, rows, tileXY, key), least recently used
+    # first.  Only the latest few are kept, as every scale needs its own
+    tables = OrderedDict()
+    max_tables = 16
+    lock = threading.Lock()
+
+    # the shared geometry for a board, where key identifies topLeft (such as
+    # the rendering scale)
+    @staticmethod
+    def get(cols, rows, tileXY, topLeft, key):
+        k = (cols, rows, tuple(tileXY), key)
+        with HexGeometry.lock:
+            geometry = HexGeometry.tables.pop(k, None)
+            if geometry is None:
+                geometry = HexGeometry(cols, rows, tileXY, topLeft)
+            HexGeometry.tables[k] = geometry        # now the most recently used
+            while len(HexGeometry.tables) > HexGeometry.max_tables:
+                HexGeometry.tables.popitem(last=False)
+        return geometry
+
+    def __init__(self, cols, rows, tileXY, topLeft):
+        self.cols = cols
+        self.rows = rows
+        self.tileXY = XY(*tileXY)
+        self.topLeftAt = topLeft
+
+        # one extra row and column, for the edges of the board
+        self.topLefts = {}
+        for row in xrange(rows + 1):
+            for col in xrange(cols + 1):
+                self.topLefts[(row, col)] = topLeft(row, col)
+        half = self.tileXY / 2
+        self.centres = dict((rc, xy + half) for (rc, xy) in self.topLefts.items())
+
+        # the rows are horizontal, so each has a single top edge, and
+        # alternate rows are offset by half a hex
+        self.tops = [self.topLefts[(row, 0)].y for row in xrange(rows + 1)]
+        self.lefts = [[self.topLefts[(parity, col)].x for col in xrange(cols + 1)]
+            for parity in [0, 1]]
+
+    # number of hexes in a row; odd rows are one hex shorter
+    def rowLength(self, row):
+        return self.cols - row % 2
+
+    # the top-left corner of the tile in row, col
+    def topLeft(self, row, col):
+        xy = self.topLefts.get((row, col))
+        if xy is None:          # off the board
+            xy = self.topLeftAt(row, col)
+        return xy
+
+    # the top-left corner of a hex in m44 coordinates, where even rows have
+    # even columns and odd rows have odd columns
+    def topLeft2(self, row, col2):
+        return self.topLeft(row, (col2 - row % 2) / 2)
+
+    def centre(self, row, col):
+        xy = self.centres.get((row, col))
+        if xy is None:
+            xy = self.topLeftAt(row, col) + self.tileXY / 2
+        return xy
+
+    # the (row, col) of every tile overlapping box (left, upper, right, lower),
+    # in painting order (row by row), for tiles of size (default tileXY)
+    def overlapping(self, box, size = None):
+        (x0, y0, x1, y1) = box
+        (w, h) = size or self.tileXY
+        cells = []
+        for row in xrange(bisect_right(self.tops, y0 - h),
+                min(self.rows, bisect_left(self.tops, y1))):
+            lefts = self.lefts[row % 2]
+            for col in xrange(bisect_right(lefts, x0 - w),
+                    min(self.rowLength(row), bisect_left(lefts, x1))):
+                cells.append((row, col))
+        return cells
+
+    # the (row, col2) in m44 coordinates of the hex containing pixel (x, y),
+    # or None if it isn't on a hex of the board
+    def hexAt(self, (x, y)):
+        # candidates are the hexes in the rows and columns whose tiles span
+        # the pixel.  Neighbouring hexes can overlap by a pixel, in which
+        # case the one painted last (and so on top) wins
+        found = None
+        row0 = bisect_right(self.tops, y) - 1
+        for row in [row0 - 1, row0]:
+            if not 0 <= row < self.rows:
+                continue
+            col0 = bisect_right(self.lefts[row % 2], x) - 1
+            for col in [col0 - 1, col0]:
+                if not 0 <= col < self.rowLength(row):
+                    continue
+                (cx, cy) = self.centres[(row, col)]
+                if self.inside(x - cx, y - cy):
+                    found = (row, 2 * col + row % 2)
+        return found
+
+    # is an offset from a hex centre inside the hex?  Hexes are pointy-topped,
+    # with vertical sides a tile width apart
+    def inside(self, dx, dy):
+        (w, h) = self.tileXY
+        dx, dy = abs(dx), abs(dy)
+        return 2 * dx <= w and dy <= h / 2. - h / 2. * dx / w
+
+    # the corners of a hex in m44 coordinates, e.g. for an image map
+    def polygon(self, row, col2):
+        (x, y) = self.topLeft2(row, col2)
+        (w, h) = self.tileXY
+        return [(x + w / 2, y), (x + w, y + h / 4), (x + w, y + h - h / 4),
+            (x + w / 2, y + h), (x, y + h - h / 4), (x, y + h / 4)]
@@ -0,0 +1,85 @@
+import threading
+from collections import OrderedDict
+
+import profiling
+
+# decoded images (or None, for images that couldn't be loaded) kept in memory
+# up to a budget of maxBytes, evicting the least recently used images when
+# it is exceeded.  Safe to share between threads, e.g. in the render service.
+# Counts hits, misses, evictions and reloads (misses for images that had
+# been evicted), see stats, and profiling counts evictions and reloads as
+# <name>.evicted and <name>.reload
+class ImageCache:
+    missing = object()      # what get returns for keys that aren't cached
+    
+    def __init__(self, maxBytes = 512 * 2**20, name = 'art'):
+        self.maxBytes = maxBytes
+        self.name = name
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.images = OrderedDict()     # key => (image, bytes), oldest first
+            self.bytes = 0
+            self.evicted = set()            # keys of images evicted so far
+            self.hits = self.misses = self.evictions = self.reloads = 0
+
+    # the bytes PIL uses for an image's pixels
+    @staticmethod
+    def imageBytes(image):
+        if image is None:
+            return 0
+        (w, h) = image.size
+        return w * h * (1 if image.mode in ('1', 'L', 'P') else 4)
+
+    # the image cached for key, or missing if it isn't cached
+    def get(self, key):
+        with self.lock:
+            entry = self.images.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                if key in self.evicted:
+                    self.reloads += 1
+                    profiling.count(self.name + '.reload')
+                return ImageCache.missing
+            self.images[key] = entry        # now the most recently used
+            self.hits += 1
+            return entry[0]
+
+    # cache an image for key, evicting others to stay within budget.  An image
+    # bigger than the whole budget isn't kept
+    def put(self, key, image):
+        size = ImageCache.imageBytes(image)
+        with self.lock:
+            if key in self.images:
+                self.bytes -= self.images.pop(key)[1]
+            if size > self.maxBytes:
+                return image
+            self.images[key] = (image, size)
+            self.bytes += size
+            while self.bytes > self.maxBytes:
+                (oldKey, (old, oldSize)) = self.images.popitem(last=False)
+                self.bytes -= oldSize
+                self.evicted.add(oldKey)
+                self.evictions += 1
+                profiling.count(self.name + '.evicted')
+        return image
+
+    def stats(self):
+        with self.lock:
+            return { 'images' : len(self.images), 'resident_bytes' : self.bytes,
+                'max_bytes' : self.maxBytes, 'hits' : self.hits,
+                'misses' : self.misses, 'evictions' : self.evictions,
+                'reloads' : self.reloads }
+
+    # the lock can't be pickled (e.g. for worker processes on Windows), and
+    # the images needn't be, so unpickle as an empty cache
+    def __getstate__(self):
+        return { 'maxBytes' : self.maxBytes, 'name' : self.name }
+
+    def __setstate__(self, state):
+        self.maxBytes = state['maxBytes']
+        self.name = state['name']
+        self.lock = threading.Lock()
+        self.clear()
@@ -0,0 +1,135 @@
+import json, os, time
+import hashlib
+from os import path
+from shutil import copy2, rmtree
+import logging
+
+import profiling
+
+# a cache of the files written by earlier renders, so a scenario rendered
+# again with the same options and art just gets links to the old files.
+# Entries are keyed by a digest of everything the output depends on (see
+# key), and each is a folder named by its key holding the files and a
+# manifest listing them by their name after the output base (like
+# '0101.png').  Files are hard-linked in and out of the cache where the
+# file system allows, and copied otherwise.  When the files in the cache
+# add up to more than maxBytes, the least recently used entries are removed
+class OutputCache:
+    version = 1         # bump if the cached files or manifest change
+
+    def __init__(self, folder, maxBytes = 1024 * 2**20):
+        self.folder = folder
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # a digest of a scenario (the .m44 file contents), the options it is
+    # rendered with (a dictionary of JSON values), a fingerprint of the art
+    # it uses and anything else (like the code) that changes the output
+    @staticmethod
+    def key(scenario, options, fingerprint, *extra):
+        digest = hashlib.sha1()
+        digest.update(json.dumps([OutputCache.version, options, fingerprint]
+            + list(extra), sort_keys=True))
+        digest.update(scenario)
+        return digest.hexdigest()
+
+    # link the files cached for key to output_base + their names, returning
+    # the list of files, or None if there is no (complete) entry for key
+    def lookup(self, key, output_base):
+        entry = path.join(self.folder, key)
+        try:
+            with open(path.join(entry, 'manifest.json')) as f:
+                manifest = json.load(f)
+            outputs = []
+            for (n, (suffix, size)) in enumerate(manifest['files']):
+                fname = path.join(entry, '%d%s'%(n, path.splitext(suffix)[1]))
+                if os.stat(fname).st_size != size:
+                    raise ValueError("%s has changed"%fname)
+                outputs.append((fname, output_base + suffix))
+            for (fname, output) in outputs:
+                linkFile(fname, output)
+            os.utime(path.join(entry, 'manifest.json'), None)   # recently used
+        except (IOError, OSError, ValueError, KeyError), e:
+            if path.exists(entry):
+                logging.warn("Discarding output cache entry %s: %s"%(key, e))
+                rmtree(entry, ignore_errors=True)
+            self.misses += 1
+            profiling.count('output.miss')
+            return None
+        self.hits += 1
+        profiling.count('output.hit')
+        return [output for (fname, output) in outputs]
+
+    # add the files written for key, named output_base + suffix, to the cache
+    def store(self, key, output_base, outputs):
+        entry = path.join(self.folder, key)
+        tmp = entry + '.%d'%os.getpid()
+        files = []
+        try:
+            os.makedirs(tmp)
+            for (n, fname) in enumerate(outputs):
+                suffix = fname[len(output_base):]
+                linkFile(fname, path.join(tmp, '%d%s'%(n, path.splitext(suffix)[1])))
+                files.append((suffix, os.stat(fname).st_size))
+            with open(path.join(tmp, 'manifest.json'), 'w') as f:
+                json.dump({ 'files' : files, 'created' : time.time() }, f)
+            # another process may have stored the same entry meanwhile
+            if path.exists(entry):
+                rmtree(entry, ignore_errors=True)
+            os.rename(tmp, entry)
+        except (IOError, OSError), e:
+            logging.warn("Couldn't add %s to the output cache: %s"%(output_base, e))
+            rmtree(tmp, ignore_errors=True)
+            return
+        self.evict()
+
+    # (key, total bytes, last used) for each entry, least recently used first
+    def entries(self):
+        entries = []
+        if not path.isdir(self.folder):
+            return entries
+        for key in os.listdir(self.folder):
+            entry = path.join(self.folder, key)
+            try:
+                used = os.stat(path.join(entry, 'manifest.json')).st_mtime
+                size = sum(os.stat(path.join(entry, fname)).st_size
+                    for fname in os.listdir(entry))
+            except OSError:         # not a complete entry
+                continue
+            entries.append((key, size, used))
+        entries.sort(key = lambda (key, size, used): used)
+        return entries
+
+    # remove the least recently used entries until the cache fits in maxBytes
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for (key, size, used) in entries)
+        for (key, size, used) in entries:
+            if total <= self.maxBytes:
+                break
+            rmtree(path.join(self.folder, key), ignore_errors=True)
+            total -= size
+            self.evictions += 1
+            profiling.count('output.evicted')
+
+    # a one-line summary of the hits and misses so far, and the cache size
+    def report(self):
+        entries = self.entries()
+        return "Output cache: %d hit(s), %d miss(es), %d evicted, " \
+            "%d entries using %.1fMB of %.0fMB"%(self.hits, self.misses,
+                self.evictions, len(entries),
+                sum(size for (key, size, used) in entries) / 2.**20,
+                self.maxBytes / 2.**20)
+
+# hard-link (or failing that, copy) src to dst, replacing any existing dst
+def linkFile(src, dst):
+    if path.lexists(dst):
+        os.remove(dst)
+    elif path.dirname(dst) and not path.isdir(path.dirname(dst)):
+        os.makedirs(path.dirname(dst))      # e.g. for a pyramid's tiles
+    try:
+        os.link(src, dst)
+    except (AttributeError, OSError):     # no links on Windows, or another device
+        copy2(src, dst)
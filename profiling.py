@@ -0,0 +1,108 @@
+import json, os, time
+import threading
+from collections import defaultdict
+
+# records timed spans (like loading the art index, painting a layer or saving
+# a page) and event counters (like image cache hits and misses) while a run
+# is being profiled.  Instrumented code calls the module-level span() and
+# count(), which do nothing unless a profiler has been started, so they are
+# cheap enough to leave in place.  Only the process that started the
+# profiler is recorded, not batch or encoder worker processes
+class Profiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.spans = []         # (name, start, duration, thread, args)
+        self.counters = defaultdict(int)
+
+    def span(self, name, **args):
+        return Span(self, name, args)
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] += n
+
+    # total, count and longest duration of the spans with each name
+    def summary(self):
+        phases = {}
+        for (name, start, duration, thread, args) in list(self.spans):
+            phase = phases.setdefault(name, { 'count' : 0, 'total_s' : 0., 'max_s' : 0. })
+            phase['count'] += 1
+            phase['total_s'] += duration
+            phase['max_s'] = max(phase['max_s'], duration)
+        return phases
+
+    # save the summary, counters and every span as JSON
+    def save(self, fname):
+        with open(fname, 'w') as f:
+            json.dump({ 'started' : self.started,
+                'elapsed_s' : time.time() - self.started,
+                'summary' : self.summary(),
+                'counters' : dict(self.counters),
+                'spans' : [{ 'name' : name, 'start_s' : start - self.started,
+                        'duration_s' : duration, 'thread' : thread, 'args' : args }
+                    for (name, start, duration, thread, args) in list(self.spans)]
+                }, f, indent=1, sort_keys=True)
+
+    # save the spans in Chrome's trace event format, for chrome://tracing
+    def saveTrace(self, fname):
+        pid = os.getpid()
+        events = [{ 'name' : name, 'ph' : 'X', 'pid' : pid, 'tid' : thread,
+                'ts' : int((start - self.started) * 1e6),
+                'dur' : int(duration * 1e6), 'args' : args }
+            for (name, start, duration, thread, args) in list(self.spans)]
+        with open(fname, 'w') as f:
+            json.dump({ 'traceEvents' : events, 'displayTimeUnit' : 'ms' }, f)
+
+# a span being timed, recorded when it ends.  Extra details can be added
+# to args while it is running, e.g. to note how an image was found
+class Span:
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.time() - self.start
+        self.profiler.spans.append((self.name, self.start, duration,
+            threading.current_thread().ident, self.args))
+
+# stands in for a span when nothing is being profiled
+class NullSpan:
+    def __init__(self):
+        self.args = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+null_span = NullSpan()
+
+active = None           # the profiler recording spans, if any
+
+# start recording spans and counters, returning the new profiler
+def start():
+    global active
+    active = Profiler()
+    return active
+
+# stop recording, returning the profiler that was active
+def stop():
+    global active
+    profiler, active = active, None
+    return profiler
+
+def span(name, **args):
+    if active is None:
+        return null_span
+    return active.span(name, **args)
+
+def count(name, n = 1):
+    if active is not None:
+        active.count(name, n)
@@ -0,0 +1,256 @@
+#!/usr/bin/python
+import json, sys, time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urlparse import urlsplit, parse_qsl
+from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
+from multiprocessing import cpu_count
+from collections import deque
+from zipfile import ZipFile, ZIP_STORED
+from cStringIO import StringIO
+import threading
+import logging
+
+# local imports
+import drawboard
+
+# request counts and timings for the render service.  Latencies (from
+# arrival to response, in seconds) are kept for the most recent requests
+class RenderMetrics:
+    def __init__(self, window = 1000):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.rejected = 0           # turned away because the queue was full
+        self.failed = 0
+        self.completed = 0
+        self.queued = 0             # waiting for a worker
+        self.active = 0             # being rendered
+        self.waits = deque(maxlen=window)
+        self.latencies = deque(maxlen=window)
+
+    def count(self, name, delta = 1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + delta)
+
+    def record(self, wait, latency):
+        with self.lock:
+            self.waits.append(wait)
+            self.latencies.append(latency)
+
+    # summary statistics for a list of timings
+    @staticmethod
+    def summary(values):
+        if not values:
+            return { 'count' : 0 }
+        values = sorted(values)
+        pick = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+        return { 'count' : len(values), 'mean' : sum(values) / len(values),
+            'p50' : pick(0.5), 'p95' : pick(0.95), 'max' : values[-1] }
+
+    def snapshot(self):
+        with self.lock:
+            return { 'uptime' : time.time() - self.started,
+                'requests' : self.requests, 'rejected' : self.rejected,
+                'failed' : self.failed, 'completed' : self.completed,
+                'queue_depth' : self.queued, 'active' : self.active,
+                'queue_wait' : RenderMetrics.summary(list(self.waits)),
+                'latency' : RenderMetrics.summary(list(self.latencies)) }
+
+class ServiceBusy(Exception):
+    pass
+
+# renders scenarios with one warm art library on a bounded pool of worker
+# threads, with at most maxQueue requests waiting for a worker
+class RenderService:
+    # request options, and the drawboard command line options they map to.
+    # Flags (like nomarks) take a true/false value
+    options = {
+        'xlayers' : '--xlayers',
+        'hexwidth' : '--hexwidth',
+        'dpi_target' : '--dpi-target',
+        'page_size' : '--page_size',
+        'margin' : '--margin',
+        'overlap' : '--overlap',
+        'nomarks' : '--nomarks',
+        'dpi' : '--dpi',
+        'encoder' : '--encoder'
+    }
+    flags = ['nomarks']
+
+    def __init__(self, icons, workers = None, maxQueue = 32):
+        self.icons = icons
+        self.workers = workers or cpu_count()
+        self.maxQueue = maxQueue
+        self.pool = ThreadPool(self.workers)
+        self.metrics = RenderMetrics()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    # parse request options into drawboard arguments, raising ValueError
+    # if any are unknown or invalid
+    def parseOptions(self, options):
+        argv = ['scenario.m44']
+        for (key, value) in sorted(options.items()):
+            if key not in RenderService.options:
+                raise ValueError("unknown option %s"%key)
+            if key in RenderService.flags:
+                if value.lower() in ['1', 'true', 'yes']:
+                    argv.append(RenderService.options[key])
+            else:
+                argv += [RenderService.options[key], value]
+        try:
+            return drawboard.setupArgParser().parse_args(argv)
+        except SystemExit:      # argparse has already described the problem
+            raise ValueError("invalid options %s"%' '.join(argv[1:]))
+
+    # render a scenario (the contents of an .m44 file) with the given options,
+    # returning (content type, data): a PNG for a single page, a PDF with
+    # the pdf encoder, or else a zip of the page images
+    def render(self, scenario, options):
+        arrived = time.time()
+        self.metrics.count('requests')
+        try:
+            json.loads(scenario)
+            args = self.parseOptions(options)
+        except ValueError:
+            self.metrics.count('failed')
+            raise
+
+        with self.metrics.lock:
+            if self.metrics.queued >= self.maxQueue:
+                self.metrics.rejected += 1
+                raise ServiceBusy("%d requests already waiting"%self.metrics.queued)
+            self.metrics.queued += 1
+
+        try:
+            result = self.pool.apply(self.renderJob, (scenario, args, arrived))
+        except Exception:
+            self.metrics.count('failed')
+            raise
+        self.metrics.count('completed')
+        self.metrics.record(result[0], time.time() - arrived)
+        return result[1:]
+
+    # render in a worker thread, returning (queue wait, content type, data)
+    def renderJob(self, scenario, args, arrived):
+        with self.metrics.lock:
+            self.metrics.queued -= 1
+            self.metrics.active += 1
+        wait = time.time() - arrived
+
+        try:
+            outputs = drawboard.renderPages(self.icons, scenario, args)
+
+            # a single image, or a pdf of all the pages
+            if len(outputs) == 1 and (args.page_size == ['none'] or 
+                    outputs[0][0].endswith('.pdf')):
+                content_type = outputs[0][0].endswith('.pdf') and 'application/pdf' \
+                    or 'image/png'
+                return (wait, content_type, outputs[0][1])
+
+            # the pages are already compressed, so just store them
+            data = StringIO()
+            with ZipFile(data, 'w', ZIP_STORED) as z:
+                for (fname, contents) in outputs:
+                    z.writestr(fname, contents)
+            return (wait, 'application/zip', data.getvalue())
+        finally:
+            self.metrics.count('active', -1)
+
+# POST /render?option=value&... with the .m44 file as the body renders it,
+# and GET /metrics reports the service metrics as JSON
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, content_type, data):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def replyError(self, status, message):
+        self.reply(status, 'text/plain', message + '\n')
+
+    def do_GET(self):
+        if urlsplit(self.path).path == '/metrics':
+            metrics = self.server.service.metrics.snapshot()
+            metrics['art_cache'] = self.server.service.icons.cacheStats()
+            metrics['label_cache'] = self.server.service.icons.cacheStats(labels = True)
+            metrics['plate_cache'] = drawboard.Board.plates.stats()
+            self.reply(200, 'application/json', json.dumps(metrics))
+        else:
+            self.replyError(404, "Unknown path %s"%self.path)
+
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        scenario = self.rfile.read(length)
+        if parts.path != '/render':
+            self.replyError(404, "Unknown path %s"%self.path)
+            return
+
+        try:
+            (content_type, data) = self.server.service.render(scenario,
+                dict(parse_qsl(parts.query)))
+        except ServiceBusy, e:
+            self.replyError(503, "Busy: %s"%e)
+        except (ValueError, KeyError, TypeError), e:
+            self.replyError(400, "Bad request: %s: %s"%(e.__class__.__name__, e))
+        except Exception, e:
+            logging.exception("Failed to render scenario")
+            self.replyError(500, "Failed: %s: %s"%(e.__class__.__name__, e))
+        else:
+            self.reply(200, content_type, data)
+
+    def log_message(self, format, *args):
+        logging.info("%s - %s"%(self.address_string(), format%args))
+
+class RenderServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, service, address = ('127.0.0.1', 8044)):
+        HTTPServer.__init__(self, address, RenderRequestHandler)
+        self.service = service
+
+def setupArgParser():
+    parser = ArgumentParser(
+        description = "Serve Memoir 44 board renders over HTTP on this machine")
+    parser.add_argument('-a','--appdir', default=None,
+        help='Pathname of the Memoir 44 Editor folder')
+    parser.add_argument('--port', type=int, default=8044,
+        help="Port to listen on (on localhost only)")
+    parser.add_argument('-j','--jobs', type=int, default=None,
+        help="Number of scenarios to render at once (default: one per CPU)")
+    parser.add_argument('--queue', type=int, default=32,
+        help="Number of requests that can wait for a worker before more are refused")
+    parser.add_argument('--art-cache-mb', dest='art_cache_mb', type=int, default=512,
+        help="Memory in MB for decoded art, beyond which the least recently used is dropped")
+    return parser
+
+########################################
+
+if __name__ == "__main__":
+    args = setupArgParser().parse_args()
+
+    # all the art must already be downloaded, since we never go online
+    icons = drawboard.openArtLibrary(args.appdir, imageURL=None, 
+        cacheBytes = args.art_cache_mb * 2**20)
+    if not icons:
+        sys.exit(-1)
+
+    service = RenderService(icons, args.jobs, args.queue)
+    server = RenderServer(service, ('127.0.0.1', args.port))
+    print "Serving renders on http://127.0.0.1:%d/render with %d worker(s)"%(
+        args.port, service.workers)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -1,9 +1,17 @@
-import json, sys
+import json, os, sys, time
+import logging
 from os import path
+from tempfile import mkdtemp
+from shutil import rmtree
 from PIL import Image, ImageDraw
 from argparse import ArgumentParser, ArgumentTypeError
+from multiprocessing import Pool, current_process
+from multiprocessing.pool import ThreadPool
+from threading import BoundedSemaphore
+from cStringIO import StringIO
 
 from xy import XY
+import profiling
 
 page_sizes = {
     'none': None,
@@ -19,6 +27,29 @@ page_sizes = {
     '11x17'  : XY(11,17)
 }
 
+# ways of encoding the pages: the file extension, options for PIL's save
+# (including the format, for saving to memory), whether to quantize pages to
+# an 8-bit palette first, and whether all the pages go in a single file (at
+# their physical page size, with margins).  PIL writes RGB pages into a PDF
+# as JPEG (palette pages would be hex-encoded, and far bigger), so pdf is
+# lossy
+encoder_profiles = {
+    'png' :     { 'ext' : '.png', 'options' : { 'format' : 'PNG' } },
+    'fast' :    { 'ext' : '.png', 'options' : { 'format' : 'PNG', 'compress_level' : 1 } },
+    'palette' : { 'ext' : '.png', 'options' : { 'format' : 'PNG' }, 'palette' : True },
+    'pdf' :     { 'ext' : '.pdf', 'options' : { 'format' : 'PDF', 'quality' : 90 }, 
+                  'single_file' : True }
+}
+
+# argument type for a comma-separated list of page sizes
+def pageSizeList(value):
+    sizes = value.lower().split(',')
+    for size in sizes:
+        if size not in page_sizes:
+            raise ArgumentTypeError('invalid page size: %s (choose from %s)'%(
+                size, ', '.join(sorted(page_sizes.keys()))))
+    return sizes
+    
 def setupArgParser(parser = None):    
     if not parser:
         parser = ArgumentParser(
@@ -26,9 +57,13 @@ def setupArgParser(parser = None):
         parser.add_argument('source_image', help='The image to split')
         parser.add_argument('output_base', nargs='?',
             help='The base path for output image(s)')
+        parser.add_argument('--max_memory', type=int, default=256,
+            help="Memory in MB to use for pixels when splitting uncompressed "
+                "(PPM, TIFF or BMP) images, which are read a band at a time")
         
-    parser.add_argument('-p','--page_size', default='letter', choices=page_sizes.keys(),
-        help="Page size for tiled images, or none for single image")
+    parser.add_argument('-p','--page_size', default=['letter'], type=pageSizeList,
+        metavar='letter,a4,none', help="Page size(s) for tiled images, "
+            "or none for single image")
     parser.add_argument('-m','--margin', type=float, default=0.5,
         help="Margin in inches between image and each page edge")
     parser.add_argument('-o','--overlap', type=float, default=0.25,
@@ -37,6 +72,19 @@ def setupArgParser(parser = None):
         help="Don't draw registration marks on tiled images")
     parser.add_argument('--dpi',type=int, default=None,
         help="Override image DPI information")
+    parser.add_argument('--encoders',type=int, default=1,
+        help="Number of pages to encode and write in parallel")
+    parser.add_argument('--encode_processes',action='store_true',default=False,
+        help="Encode pages in worker processes rather than threads")
+    parser.add_argument('--encoder', default='png', choices=sorted(encoder_profiles.keys()),
+        help="How to encode pages: png (default), fast (quick, larger png), "
+            "palette (8-bit png), or pdf (a single multi-page file, with "
+            "JPEG-compressed pages)")
+    parser.add_argument('--compare_encoders',action='store_true',default=False,
+        help="Report the time and size of the pages with each encoder")
+    parser.add_argument('--pyramid', type=int, default=None, choices=[256, 512],
+        help="Instead of pages, save a deep zoom (DZI) pyramid of tiles this "
+            "many pixels square, for web viewers")
     return parser
     
 # divide an overall dimension into interval length chunks with given overlap
@@ -47,35 +95,67 @@ def subdivide(overall, interval, overlap):
         xs.append(xs[-1] + interval - overlap)
     return xs
 
-# entrypoint for external caller that is using our argument processing
-def saveTiledImagesArgs(image, basename, args, ext='.png'):
-    saveTiledImages(image, basename,
-        page_sizes[args.page_size], args.margin, args.overlap,
-        ext, args.dpi, register_marks = not args.nomarks)
-        
-def saveTiledImages(image, basename, 
-    pageXY_inches, margin_inches, overlap_inches,
-    ext = '.png', dpi = None, register_marks = True):        
+# entrypoint for external caller that is using our argument processing.
+# args.page_size is a list of page sizes; with more than one, the pages for
+# each size are named basename-size and all the sizes are saved at once.
+# dpi is used if args doesn't override it, and otherwise the image's own.
+# With args.pyramid, a deep zoom pyramid is saved instead of pages.
+# See saveTiledImages for files
+def saveTiledImagesArgs(image, basename, args, ext = None, regions = None, 
+        dpi = None, files = None):
+    sizes = args.page_size
+    if isinstance(sizes, basestring):
+        sizes = [sizes]
+    dpi = args.dpi or dpi
     
-    if not dpi:
-        try:
-            dpi = image.info['dpi'][0]
-        except:
-            sys.exit("savedTiledImages: No DPI specified explicitly or found in image")
+    if getattr(args, 'pyramid', None):
+        if files is not None:
+            raise ValueError("Pyramids can only be saved to files")
+        with profiling.span('pyramid'):
+            return savePyramid(image, basename, args.pyramid, dpi,
+                encoder = getattr(args, 'encoder', 'png'))
     
-    if not pageXY_inches:     # just save full size image
-        fname = basename + ext
-        image.save(fname, dpi=(dpi,dpi))
-        return [fname]          # early return
+    if getattr(args, 'compare_encoders', False):
+        for size in sizes:
+            printEncoderReport(compareEncoders(image, page_sizes[size], 
+                args.margin, args.overlap, dpi, register_marks = not args.nomarks))
+            
+    def save(size):
+        return saveTiledImages(image, 
+            basename + ('-' + size if len(sizes) > 1 else ''),
+            page_sizes[size], args.margin, args.overlap,
+            ext, dpi, register_marks = not args.nomarks,
+            encoders = getattr(args, 'encoders', 1),
+            processes = getattr(args, 'encode_processes', False),
+            regions = regions, encoder = getattr(args, 'encoder', 'png'), 
+            files = files)
+    # a banded image reads one band at a time, so can't be shared
+    if getattr(image, 'banded', False):
+        return sum(map(save, sizes), [])
+    return concurrently(save, sizes)
+    
+# call fn for each of items on its own thread, returning the concatenated
+# lists it returns, in the order of items
+def concurrently(fn, items):
+    if len(items) < 2:
+        return sum(map(fn, items), [])
+    pool = ThreadPool(len(items))
+    try:
+        return sum(pool.map(fn, items), [])
+    finally:
+        pool.close()
+        pool.join()
         
-    # create the split up images
+# plan the pages for tiling an image of fullXY_px pixels, trying both 
+# portrait and landscape orientations.  Returns a list of 
+# (i, j, (left, upper, right, lower)) page boxes in column order,
+# the number of pages XY, and the overlap in pixels
+def planTiles(fullXY_px, pageXY_inches, margin_inches, overlap_inches, dpi):
     margin_px = int(margin_inches * dpi)
     overlap_px = int(overlap_inches * dpi)
     
     tileXY_px = (pageXY_inches * dpi - XY(1,1)*2*margin_px).ints()
     
-    fullXY_px = XY(*image.size)
-    
     # Try tiling both portrait and landscape modes
     tiling1 = XY( 
         subdivide(fullXY_px.x, tileXY_px.x, overlap_px),
@@ -101,45 +181,439 @@ def saveTiledImages(image, basename,
         pages = pages2
         tileXY_px = tileXY_px.swap() 
     
-    outputs = []
+    boxes = []
     for i,x in enumerate(map(int,tiling.x)):
         for j,y in enumerate(map(int,tiling.y)):
-            tile = image.crop(
-              (x,y, 
-               min(fullXY_px.x, x+tileXY_px.x), min(fullXY_px.y, y+tileXY_px.y)))
-            tile.load()     # force a non-destructive copy
-            
-            # possibly draw register marks
-            if register_marks:
-                canvas = ImageDraw.Draw(tile)
-                xt,yt = tile.size
-                d = overlap_px/10
-                xo,yo = overlap_px/2,overlap_px/2
-                if i > 0 or j > 0:
-                    canvas.line((xo-d,yo,0,yo),width=1,fill='black')
-                    canvas.line((xo,yo-d,xo,0),width=1,fill='black')
-                    
-                xo,yo = overlap_px/2,yt-overlap_px/2
-                if i > 0 or j+1 < pages.y:
-                    canvas.line((xo-d,yo,0, yo),width=1,fill='black')
-                    canvas.line((xo,yo+d,xo,yt),width=1,fill='black')                        
-            
-                xo,yo = xt-overlap_px/2,overlap_px/2
-                if i+1 < pages.x or j > 0:  
-                    canvas.line((xo+d,yo,xt,yo),width=1,fill='black')
-                    canvas.line((xo,yo-d,xo,0 ),width=1,fill='black')
-                    
-                xo,yo = xt-overlap_px/2,yt-overlap_px/2
-                if i+1 < pages.x or j+1 < pages.y:               
-                    canvas.line((xo+d,yo,xt,yo),width=1,fill='black')
-                    canvas.line((xo,yo+d,xo,yt),width=1,fill='black')
+            boxes.append((i, j, (x,y, 
+               min(fullXY_px.x, x+tileXY_px.x), min(fullXY_px.y, y+tileXY_px.y))))
+    
+    return boxes, pages, overlap_px
+    
+# draw registration marks in the overlap at each corner of page (i,j)
+# that adjoins another page
+def drawRegisterMarks(tile, i, j, pages, overlap_px):
+    canvas = ImageDraw.Draw(tile)
+    xt,yt = tile.size
+    d = overlap_px/10
+    xo,yo = overlap_px/2,overlap_px/2
+    if i > 0 or j > 0:
+        canvas.line((xo-d,yo,0,yo),width=1,fill='black')
+        canvas.line((xo,yo-d,xo,0),width=1,fill='black')
+        
+    xo,yo = overlap_px/2,yt-overlap_px/2
+    if i > 0 or j+1 < pages.y:
+        canvas.line((xo-d,yo,0, yo),width=1,fill='black')
+        canvas.line((xo,yo+d,xo,yt),width=1,fill='black')                        
+
+    xo,yo = xt-overlap_px/2,overlap_px/2
+    if i+1 < pages.x or j > 0:  
+        canvas.line((xo+d,yo,xt,yo),width=1,fill='black')
+        canvas.line((xo,yo-d,xo,0 ),width=1,fill='black')
+        
+    xo,yo = xt-overlap_px/2,yt-overlap_px/2
+    if i+1 < pages.x or j+1 < pages.y:               
+        canvas.line((xo+d,yo,xt,yo),width=1,fill='black')
+        canvas.line((xo,yo+d,xo,yt),width=1,fill='black')
+        
+# do two (left, upper, right, lower) boxes share any pixels?
+def overlaps(box1, box2):
+    return box1[0] < box2[2] and box2[0] < box1[2] and \
+        box1[1] < box2[3] and box2[1] < box1[3]
+        
+# remove any old copy of a file about to be written, rather than writing
+# over it, in case it is hard-linked elsewhere (like the output cache)
+def removeOld(fname):
+    if path.lexists(fname):
+        os.remove(fname)
+        
+# encode and write one page with an encoder profile, or with files (a 
+# dictionary) store the encoded page there by fname instead
+def encodeTile(tile, fname, dpi, encoder = 'png', files = None):
+    profile = encoder_profiles[encoder]
+    if profile.get('palette'):
+        tile = tile.convert('RGB').quantize(256)
+    saveImage(tile, fname, files, dpi=(dpi, dpi), **profile['options'])
+    
+# save an image to fname, or to a buffer stored in files by fname
+def saveImage(image, fname, files = None, **options):
+    if files is None:
+        removeOld(fname)
+        image.save(fname, **options)
+    else:
+        data = StringIO()
+        image.save(data, **options)
+        files[fname] = data.getvalue()
+    
+# encode and write one page, returning an error message on failure.
+# Runs in a worker thread or process when pages are encoded in parallel
+def saveTile((tile, fname, dpi, encoder, files)):
+    try:
+        with profiling.span('tiles.save', fname=fname):
+            encodeTile(tile, fname, dpi, encoder, files)
+    except Exception, e:
+        return "%s: %s"%(fname, e)
+    return None
+    
+# a page for a tile, as a white image of the physical page size (turned
+# to landscape if need be) with the tile placed inside its margin
+def pageImage(tile, pageXY_inches, margin_inches, dpi):
+    margin_px = int(margin_inches * dpi)
+    pageXY_px = (pageXY_inches * dpi).ints()
+    if tile.size[0] + 2*margin_px > pageXY_px.x:
+        pageXY_px = pageXY_px.swap()
+    page = Image.new('RGB', pageXY_px, 'white')
+    page.paste(tile, (margin_px, margin_px))
+    return page
+    
+# save image as a set of pages named basename + column + row.  image can be
+# a PIL image or any stand-in providing size, info, crop() and save(), 
+# for example to render each page on demand.  
+# With encoders > 1, pages are encoded and written on a pool of threads
+# (or processes) while the next page is cropped, with at most two pages
+# per encoder in flight at once.
+# If regions is a list of (left, upper, right, lower) boxes, only the pages
+# overlapping one of them are saved, e.g. to update pages after part of 
+# the image has changed.  
+# encoder chooses one of the encoder_profiles.  For pdf, all the pages are
+# written to a single file (basename + '.pdf') at their physical page size.
+# With files (a dictionary), nothing is written to disk, and instead the
+# encoded contents of each file are stored in files by file name.
+# Returns the list of files written
+def saveTiledImages(image, basename, 
+    pageXY_inches, margin_inches, overlap_inches,
+    ext = None, dpi = None, register_marks = True,
+    encoders = 1, processes = False, regions = None, encoder = 'png',
+    files = None):        
+    
+    if not dpi:
+        try:
+            dpi = image.info['dpi'][0]
+        except:
+            sys.exit("savedTiledImages: No DPI specified explicitly or found in image")
+    
+    profile = encoder_profiles[encoder]
+    ext = ext or profile['ext']
+    if not pageXY_inches:     # just save full size image
+        fname = basename + ext
+        with profiling.span('tiles.save', fname=fname):
+            if not isinstance(image, Image.Image):  # render a stand-in in full
+                image = image.crop((0, 0) + tuple(image.size))
+            if profile.get('single_file'):      # at its own size
+                saveImage(image, fname, files, resolution=dpi, **profile['options'])
+            else:
+                encodeTile(image, fname, dpi, encoder, files)
+        return [fname]          # early return
+        
+    # create the split up images
+    boxes, pages, overlap_px = planTiles(XY(*image.size), 
+        pageXY_inches, margin_inches, overlap_inches, dpi)
+    if profile.get('single_file'):      # always rewritten in full
+        return savePages(image, basename + ext, boxes, pages, overlap_px,
+            pageXY_inches, margin_inches, dpi, register_marks, profile, files)
+    if regions is not None:
+        boxes = [(i, j, box) for (i, j, box) in boxes 
+            if any(overlaps(box, region) for region in regions)]
+    
+    pool = None
+    if encoders > 1 and len(boxes) > 1:
+        # worker processes (like our batch renderers) can't start their own,
+        # and pages kept in memory must be encoded by threads
+        if processes and files is None and not current_process().daemon:
+            pool = Pool(encoders)
+        else:
+            pool = ThreadPool(encoders)
+        pending = BoundedSemaphore(2 * encoders)
+        errors = []
+        def done(error):
+            if error:
+                errors.append(error)
+            pending.release()
+    
+    # sources read in horizontal bands want the pages a row at a time
+    banded = getattr(image, 'banded', False)
+    if banded:
+        boxes.sort(key = lambda (i, j, box): (j, i))
+        
+    outputs = []
+    try:
+        for (i, j, box) in boxes:
+            with profiling.span('tiles.crop', page=(i+1, j+1)):
+                tile = image.crop(box)
+                tile.load()     # force a non-destructive copy
+                
+                # possibly draw register marks
+                if register_marks:
+                    drawRegisterMarks(tile, i, j, pages, overlap_px)
                         
             fname = basename + '%02d%02d'%(i+1,j+1) + ext
             outputs.append(fname)
-            tile.save(fname, dpi=(dpi, dpi))
+            if pool:
+                pending.acquire()
+                pool.apply_async(saveTile, ((tile, fname, dpi, encoder, files),), 
+                    callback=done)
+            else:
+                with profiling.span('tiles.save', fname=fname):
+                    encodeTile(tile, fname, dpi, encoder, files)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    
+    if pool and errors:
+        raise IOError("Failed to save %d page(s): %s"%(len(errors), '; '.join(errors)))
             
+    if banded:
+        outputs.sort()      # back in column order
     return outputs
 
+# save the tiles in boxes as the pages of a single file, like a PDF, 
+# returning the file name
+def savePages(image, fname, boxes, pages, overlap_px, 
+        pageXY_inches, margin_inches, dpi, register_marks, profile, files = None):
+    sheets = []
+    for (i, j, box) in boxes:
+        with profiling.span('tiles.crop', page=(i+1, j+1)):
+            tile = image.crop(box)
+            tile.load()
+            if register_marks:
+                drawRegisterMarks(tile, i, j, pages, overlap_px)
+            sheets.append(pageImage(tile, pageXY_inches, margin_inches, dpi))
+            
+    with profiling.span('tiles.save', fname=fname):
+        saveImage(sheets[0], fname, files, save_all=True, append_images=sheets[1:],
+            resolution=dpi, **profile['options'])
+    return [fname]
+    
+# save image as a deep zoom (DZI) pyramid of tiles for web viewers (like
+# OpenSeadragon).  basename.dzi describes the pyramid, and the tiles are
+# basename_files/<level>/<column>_<row>.png, of tileSize pixels square
+# (smaller at the edges), from level 0 (one pixel) to the full size image 
+# at the last level.  Each tile is made by halving the four tiles below
+# it in the level above, rather than by resizing the whole image, and the
+# image is cropped a block of blockTiles x blockTiles full size tiles at a
+# time, so it can be a stand-in like BoardRegions.  Tiles which are all
+# background aren't written; basename.json lists them along with the size
+# of each level, so a viewer can fill them in.  
+# Returns the list of files written
+def savePyramid(image, basename, tileSize = 256, dpi = None, 
+        background = (255,255,255), encoder = 'png', blockTiles = 8):
+    profile = encoder_profiles[encoder]
+    if profile.get('single_file'):
+        raise ValueError("Can't save pyramid tiles with the %s encoder"%encoder)
+    if not dpi:
+        dpi = image.info.get('dpi', (72,))[0]
+    
+    (w, h) = image.size
+    maxLevel = (max(w, h) - 1).bit_length()
+    # level sizes, rounding up each time the image is halved
+    sizes = [(w, h)]
+    while len(sizes) <= maxLevel:
+        sizes.insert(0, tuple((v + 1) / 2 for v in sizes[0]))
+    
+    folder = basename + '_files'
+    if path.exists(folder):         # don't leave tiles from an earlier save
+        rmtree(folder)
+    outputs = []
+    skipped = []
+        
+    # the tile at level, col, row, saved unless it is background.  block is
+    # an (image, (left, top)) crop of the full size image covering the tile
+    def build(level, col, row, block):
+        scale = 2 ** (maxLevel - level)
+        (lw, lh) = sizes[level]
+        box = (col * tileSize, row * tileSize, 
+            min(lw, (col + 1) * tileSize), min(lh, (row + 1) * tileSize))
+        if block is None and scale <= blockTiles:
+            full = (box[0] * scale, box[1] * scale,
+                min(w, box[2] * scale), min(h, box[3] * scale))
+            with profiling.span('pyramid.crop', level=level):
+                block = (image.crop(full), full[:2])
+                
+        if level == maxLevel:
+            (pixels, (x0, y0)) = block
+            tile = pixels.crop((box[0] - x0, box[1] - y0, box[2] - x0, box[3] - y0))
+        else:
+            # the (up to) four tiles of the next level cover twice the area
+            (cw, ch) = sizes[level + 1]
+            cols = range(2 * col, min(2 * col + 2, (cw + tileSize - 1) / tileSize))
+            rows = range(2 * row, min(2 * row + 2, (ch + tileSize - 1) / tileSize))
+            merged = None
+            for r in rows:
+                for c in cols:
+                    child = build(level + 1, c, r, block)
+                    if merged is None:
+                        merged = Image.new(child.mode, (min(2 * tileSize, cw - 2 * col * tileSize),
+                            min(2 * tileSize, ch - 2 * row * tileSize)))
+                    merged.paste(child, ((c - 2 * col) * tileSize, (r - 2 * row) * tileSize))
+            tile = merged.resize((box[2] - box[0], box[3] - box[1]), Image.ANTIALIAS)
+        
+        colors = tile.getcolors(1)
+        if colors and colors[0][1] == Image.new(tile.mode, (1,1), background).getpixel((0,0)):
+            skipped.append((level, col, row))
+        else:
+            fname = path.join(folder, str(level), '%d_%d%s'%(col, row, profile['ext']))
+            if not path.isdir(path.dirname(fname)):
+                os.makedirs(path.dirname(fname))
+            with profiling.span('pyramid.save', level=level):
+                encodeTile(tile, fname, max(1, dpi / scale), encoder)
+            outputs.append(fname)
+        return tile
+        
+    build(0, 0, 0, None)
+    
+    fname = basename + '.dzi'
+    removeOld(fname)
+    with open(fname, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+            'Format="%s" Overlap="0" TileSize="%d">\n'
+            '  <Size Width="%d" Height="%d"/>\n</Image>\n'%(
+                profile['ext'][1:], tileSize, w, h))
+    outputs.insert(0, fname)
+    
+    fname = basename + '.json'
+    removeOld(fname)
+    with open(fname, 'w') as f:
+        json.dump({ 'width' : w, 'height' : h, 'tile_size' : tileSize,
+            'format' : profile['ext'][1:], 'levels' : sizes,
+            'background' : '#%02x%02x%02x'%tuple(background),
+            'skipped' : sorted(skipped) }, f)
+    outputs.insert(1, fname)
+    return outputs
+    
+# encode the pages of image with each encoder profile (in a scratch folder),
+# returning a list of (encoder, number of files, total bytes, seconds)
+def compareEncoders(image, pageXY_inches, margin_inches, overlap_inches, 
+        dpi = None, register_marks = True, encoders = None):
+    folder = mkdtemp()
+    try:
+        report = []
+        for encoder in encoders or sorted(encoder_profiles.keys()):
+            start = time.time()
+            outputs = saveTiledImages(image, path.join(folder, encoder),
+                pageXY_inches, margin_inches, overlap_inches, dpi = dpi,
+                register_marks = register_marks, encoder = encoder)
+            elapsed = time.time() - start
+            size = sum(os.stat(fname).st_size for fname in outputs)
+            report.append((encoder, len(outputs), size, elapsed))
+        return report
+    finally:
+        rmtree(folder)
+        
+def printEncoderReport(report):
+    print "%-10s %6s %12s %9s"%('encoder', 'files', 'bytes', 'seconds')
+    for (encoder, files, size, elapsed) in report:
+        print "%-10s %6d %12d %9.2f"%(encoder, files, size, elapsed)
+        
+# bytes per pixel for the raw modes BandedImage can read
+raw_pixel_bytes = { '1;8' : 1, 'L' : 1, 'P' : 1, 'RGB' : 3, 'BGR' : 3, 
+    'RGBX' : 4, 'RGBA' : 4, 'BGRX' : 4, 'BGRA' : 4 }
+    
+# a stand-in for a large uncompressed image file (like PPM, TIFF or BMP) 
+# which reads just the rows needed for each crop from the file, instead
+# of decoding the whole image.  The band of rows for the current row of
+# pages is kept for the next page if that fits within maxMemory bytes,
+# counting the band, the page cropped from it and a copy made while
+# reading.  Raises ValueError for files that aren't stored this way
+class BandedImage:
+    banded = True       # so saveTiledImages crops a row of pages at a time
+    
+    def __init__(self, fname, maxMemory = 256 * 2**20):
+        self.fname = fname
+        self.maxMemory = maxMemory
+        
+        # only the header is read here; don't refuse images for being huge
+        pixels = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            image = Image.open(fname)
+        finally:
+            Image.MAX_IMAGE_PIXELS = pixels
+        self.mode = image.mode
+        self.size = image.size
+        self.info = image.info
+        
+        # (box, file offset, stride, orientation) for each block of pixels
+        self.tiles = []
+        for (decoder, box, offset, args) in image.tile:
+            if decoder != 'raw' or not isinstance(args, tuple) or \
+                    args[0] not in raw_pixel_bytes:
+                raise ValueError("%s isn't an uncompressed image"%fname)
+            (rawmode, stride, orientation) = (tuple(args) + (0, 1))[:3]
+            if not stride:
+                stride = (box[2] - box[0]) * raw_pixel_bytes[rawmode]
+            self.tiles.append((box, offset, stride, orientation))
+            self.rawmode = rawmode
+        if len(set(args[0] for (decoder, box, offset, args) in image.tile)) != 1:
+            raise ValueError("%s mixes pixel formats"%fname)
+        self.pixelBytes = raw_pixel_bytes[self.rawmode]
+        self.band = None        # (top, bottom, image) of the rows last read
+        
+    # bytes needed to read a box of pixels: as read from the file, and
+    # decoded (PIL keeps multi-band pixels in 4 bytes)
+    def boxBytes(self, box):
+        return (box[2] - box[0]) * (box[3] - box[1]) * \
+            (self.pixelBytes + (4 if len(self.mode) > 1 else 1))
+        
+    # read the pixels in box from the file
+    def read(self, box):
+        (x0, y0, x1, y1) = box
+        (w, h) = (x1 - x0, y1 - y0)
+        bpp = self.pixelBytes
+        data = bytearray(w * h * bpp)
+        with open(self.fname, 'rb') as f:
+            for ((tx0, ty0, tx1, ty1), offset, stride, orientation) in self.tiles:
+                (ix0, iy0, ix1, iy1) = (max(x0, tx0), max(y0, ty0), 
+                    min(x1, tx1), min(y1, ty1))
+                if ix0 >= ix1 or iy0 >= iy1:
+                    continue
+                n = (ix1 - ix0) * bpp
+                if orientation > 0 and n == stride == w * bpp:
+                    # whole rows, stored one after another, so read them at once
+                    f.seek(offset + (iy0 - ty0) * stride)
+                    start = (iy0 - y0) * n
+                    data[start:start + (iy1 - iy0) * n] = f.read((iy1 - iy0) * n)
+                    continue
+                for y in xrange(iy0, iy1):
+                    row = y - ty0 if orientation > 0 else ty1 - 1 - y
+                    f.seek(offset + row * stride + (ix0 - tx0) * bpp)
+                    start = ((y - y0) * w + (ix0 - x0)) * bpp
+                    data[start:start + n] = f.read(n)
+        return Image.frombuffer(self.mode, (w, h), buffer(data), 
+            'raw', self.rawmode, 0, 1)
+        
+    def crop(self, box):
+        (x0, y0, x1, y1) = box
+        if self.band and self.band[0] <= y0 and y1 <= self.band[1]:
+            (top, bottom, band) = self.band
+            return band.crop((x0, y0 - top, x1, y1 - top))
+            
+        self.band = None
+        if self.boxBytes(box) > self.maxMemory:
+            raise ValueError("A %dx%d page needs more than the %dMB memory limit"%(
+                x1 - x0, y1 - y0, self.maxMemory / 2**20))
+        bandBox = (0, y0, self.size[0], y1)
+        if self.boxBytes(bandBox) + self.boxBytes(box) <= self.maxMemory:
+            self.band = (y0, y1, self.read(bandBox))
+            return self.crop(box)
+        return self.read(box)
+        
+    # saving the whole image means decoding all of it
+    def save(self, fname, **kwargs):
+        self.crop((0, 0) + self.size).save(fname, **kwargs)
+        
+# open an image for splitting, reading uncompressed images a band at a time
+def openImage(fname, maxMemory = 256 * 2**20):
+    try:
+        return BandedImage(fname, maxMemory)
+    except ValueError:
+        pass
+    image = Image.open(fname)
+    if image.size[0] * image.size[1] * len(image.mode) > maxMemory:
+        logging.warn("%s will be decoded in full, save it as PPM or uncompressed "
+            "TIFF to split it within the memory limit"%fname)
+    return image
+    
 ########################################
 if __name__ == "__main__":
     parser = setupArgParser()
@@ -149,11 +623,6 @@ if __name__ == "__main__":
         print "ERROR: Can't find source image",args.source_image
         sys.exit(-1)
         
-    args.page_size = args.page_size.lower()
-    if args.page_size not in page_sizes.keys():
-        print "ERROR: Unknown page size",args.page_size
-        sys.exit(-2)
-    
     # output to basename (excluding extension), based on source if not given
     if not args.output_base:
         args.output_base = args.source_image
@@ -163,9 +632,10 @@ if __name__ == "__main__":
         ext = path.splitext(args.source_image)[1]
         
     try:
-        image = Image.open(args.source_image)
+        image = openImage(args.source_image, args.max_memory * 2**20)
     except:
         print "ERROR: Couldn't open source image",args.source_image
+        sys.exit(-3)
         
     saveTiledImagesArgs(image, args.output_base, args)
     
@@ -1,10 +1,33 @@
 import unittest
-from subprocess import check_call, CalledProcessError
+from subprocess import check_call, check_output, CalledProcessError
 from glob import glob
 import os,sys
+import json
 from os import path
+from shutil import copy, copytree, rmtree
+from tempfile import mkdtemp
+
+from PIL import Image, ImageDraw
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from threading import Thread
+import httplib
+from cStringIO import StringIO
+from zipfile import ZipFile
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
 
 import drawboard
+import splitimage
+from xy import XY
+import artfetch
+import renderservice
+import benchmark
+import profiling
+from outputcache import OutputCache
+from imagecache import ImageCache
+from geometry import HexGeometry
 
 def removeImages(basename):
     for filename in glob(basename + '*.png') :
@@ -13,6 +36,9 @@ def removeImages(basename):
 class NullWriter:
     def write(self, s):
         pass
+        
+    def flush(self):
+        pass
 
 class NoOutput:
     def __enter__(self):
@@ -42,6 +68,954 @@ class BasicTests(unittest.TestCase):
             drawboard.getImageDir(),
             drawboard.base_url))
 
+    def testArtIndex(self):
+        xml_files = [ drawboard.findSedData(drawboard.app_dirs),
+            drawboard.findBgData() ]
+        folder = mkdtemp()
+        try:
+            indexFile = path.join(folder, 'index.pickle')
+            parsed = drawboard.ArtLibrary(xml_files, drawboard.getImageDir(),
+                drawboard.base_url, indexFile = False)
+            built = drawboard.ArtLibrary(xml_files, drawboard.getImageDir(),
+                drawboard.base_url, indexFile = indexFile)
+            self.assertTrue(path.isfile(indexFile))
+            loaded = drawboard.ArtLibrary(xml_files, drawboard.getImageDir(),
+                drawboard.base_url, indexFile = indexFile)
+            for library in [built, loaded]:
+                self.assertEqual(
+                    sorted(a.indexEntry() for a in library.artworks.values()),
+                    sorted(a.indexEntry() for a in parsed.artworks.values()))
+            self.assertTrue(loaded.getImage('outline'))
+            
+            # a changed source file invalidates the saved index
+            key = drawboard.ArtLibrary.indexKey(xml_files)
+            self.assertTrue(drawboard.ArtLibrary.loadIndex(indexFile, key))
+            self.assertEqual(drawboard.ArtLibrary.loadIndex(indexFile, 
+                drawboard.ArtLibrary.indexKey(xml_files[1:])), None)
+        finally:
+            rmtree(folder)
+
+    def testBackgroundPlate(self):
+        icons = drawboard.ArtLibrary([ drawboard.findBgData() ],
+            drawboard.getImageDir(), drawboard.base_url)
+        board = drawboard.Board('juno.m44')
+        drawboard.Board.plates.clear()
+        plate = board.backgroundPlate(icons)
+        self.assertTrue(plate is board.backgroundPlate(icons))
+        self.assertEqual(drawboard.Board.plates.stats()['resident_bytes'],
+            ImageCache.imageBytes(plate))
+        self.assertEqual(plate.tobytes(), board.paintBackground(icons).tobytes())
+        
+        # a fresh process would reload the same plate from the disk cache
+        drawboard.Board.plates.clear()
+        self.assertEqual(board.backgroundPlate(icons).tobytes(), plate.tobytes())
+        self.assertTrue(glob(path.join(drawboard.getCacheDir(), 'plates', 
+            'standard-beach-*.png')))
+
+    def testScaledHexesMeet(self):
+        # at a scale where the tile width has a fraction below .5, hexes are
+        # spaced by the scaled art's width, leaving no gaps between them
+        icons = drawboard.ArtLibrary([ drawboard.findBgData() ],
+            drawboard.getImageDir(), drawboard.base_url)
+        board = drawboard.Board('juno.m44')
+        board.setResolution(dpi=95)
+        self.assertTrue(0 < (drawboard.Board.hexXY.x * board.scale) % 1 < 0.5)
+        gap = (255, 0, 255)
+        image = board.paintBackground(icons, Image.new('RGB', board.size(), gap))
+        pixels = image.load()
+        geometry = board.geometry()
+        for row in xrange(board.rows):
+            y = geometry.topLeft(row, 0).y + geometry.tileXY.y / 2
+            x0 = geometry.topLeft(row, 0).x
+            x1 = geometry.topLeft(row, geometry.rowLength(row) - 1).x + geometry.tileXY.x
+            self.assertEqual([x for x in xrange(x0, x1) if pixels[x, y] == gap], [],
+                "gaps between the hexes of row %d"%row)
+
+    def testScaledImages(self):
+        icons = drawboard.ArtLibrary([ drawboard.findBgData() ],
+            drawboard.getImageDir(), drawboard.base_url)
+        image = icons.getImage('nbr_units', 3, 1.5)
+        self.assertEqual(image.size, (282, 326))
+        self.assertTrue(image is icons.getImage('nbr_units', 3, 1.5))
+        self.assertTrue(icons.getImage('nbr_units', 3, 1) is 
+            icons.getImage('nbr_units', 3))
+        
+    def testDerivedImages(self):
+        icons = drawboard.ArtLibrary([ drawboard.findBgData() ],
+            drawboard.getImageDir(), drawboard.base_url)
+        transforms = (('scale', 0.5), ('trim',), ('flip',), ('enlarge', 1.5))
+        image = icons.getDerived('nbr_units', 2, transforms)
+        self.assertTrue(image is icons.getDerived('nbr_units', 2, transforms))
+        self.assertTrue(icons.getDerived('nbr_units', 2, transforms[:1]) is
+            icons.getImage('nbr_units', 2, 0.5))
+        
+        trimmed = icons.getImage('nbr_units', 2, 0.5)
+        trimmed = trimmed.crop(trimmed.getbbox())
+        self.assertEqual(image.size, (XY(*trimmed.size) * 1.5).ints())
+        self.assertEqual(icons.getDerived('nonesuch', 1, transforms), None)
+        
+    def testImageCache(self):
+        cache = ImageCache(100000)
+        images = [Image.new('RGBA', (100, 100)) for i in xrange(3)]
+        cache.put('a', images[0])
+        cache.put('b', images[1])
+        self.assertTrue(cache.get('a') is images[0])    # now b is oldest
+        cache.put('c', images[2])
+        self.assertTrue(cache.get('b') is ImageCache.missing)
+        self.assertTrue(cache.get('a') is images[0])
+        cache.put('missing', None)
+        self.assertEqual(cache.get('missing'), None)
+        self.assertEqual(cache.stats(), { 'images' : 3, 'resident_bytes' : 80000,
+            'max_bytes' : 100000, 'hits' : 3, 'misses' : 1, 'evictions' : 1,
+            'reloads' : 1 })
+
+        # a board rendered on a small budget is the same, and no files stay open
+        board = drawboard.Board('juno.m44')
+        library = lambda cacheBytes: drawboard.ArtLibrary(
+            [ drawboard.findSedData(drawboard.app_dirs), drawboard.findBgData() ],
+            drawboard.getImageDir(), drawboard.base_url, atlasFile = False,
+            cacheBytes = cacheBytes)
+        # open files, where we can count them
+        fds = lambda: path.isdir('/proc/self/fd') and len(os.listdir('/proc/self/fd'))
+        icons = library(2**20)
+        drawboard.Board.plates.clear()
+        before = fds()
+        with NoOutput():
+            image = board.render(icons, [])
+        self.assertEqual(fds(), before)
+        stats = icons.cacheStats()
+        self.assertTrue(0 < stats['resident_bytes'] <= 2**20)
+        self.assertTrue(stats['evictions'] > 0)
+        drawboard.Board.plates.clear()
+        with NoOutput():
+            self.assertEqual(image.tobytes(),
+                board.render(library(512 * 2**20), []).tobytes())
+
+    def testLabels(self):
+        icons = drawboard.ArtLibrary([ drawboard.findBgData() ],
+            drawboard.getImageDir(), drawboard.base_url)
+        (mask, wh) = icons.getLabel('Juno', 32)
+        self.assertEqual(icons.getLabel('Juno', 32), (mask, wh))
+        self.assertEqual(mask.size, wh)
+        self.assertTrue(icons.getFont(32) is icons.getFont(32))
+        stats = icons.cacheStats(labels = True)
+        self.assertEqual((stats['images'], stats['hits']), (1, 1))
+        self.assertEqual(stats['resident_bytes'], wh.x * wh.y)
+        
+        # painting through the mask is the same as drawing the text
+        drawn = Image.new('RGB', (200,100), 'white')
+        ImageDraw.Draw(drawn).text((10,20), 'Juno', fill='black', 
+            font=icons.getFont(32))
+        pasted = Image.new('RGB', (200,100), 'white')
+        pasted.paste('black', (10,20), mask)
+        self.assertEqual(drawn.tobytes(), pasted.tobytes())
+        
+    def testAtlas(self):
+        folder = mkdtemp()
+        try:
+            imageDir = path.join(folder, 'images')
+            os.makedirs(imageDir)
+            copy(drawboard.findBgData(), imageDir)
+            copytree(path.join(drawboard.getImageDir(), 'bg_188_217'), 
+                path.join(imageDir, 'bg_188_217'))
+            library = lambda: drawboard.ArtLibrary(
+                [ path.join(imageDir, 'bg_data.xml') ], imageDir, None)
+            
+            icons = library()
+            self.assertEqual(icons.atlas, None)
+            self.assertEqual(icons.buildAtlas(), 15)    # including 9 nbr_units
+            
+            icons = library()
+            image = icons.getImage('nbr_units', 4)
+            self.assertTrue(image.readonly)
+            png = Image.open(path.join(imageDir, 'bg_188_217', 'numtag4.png'))
+            self.assertEqual(image.tobytes(), png.convert('RGBA').tobytes())
+            
+            # replaced art is loaded from its file rather than the atlas
+            fname = path.join(imageDir, 'bg_188_217', 'snow.png')
+            os.utime(fname, (0, 0))
+            icons = library()
+            self.assertEqual(icons.atlas.getImage('bg_188_217/snow.png', fname), None)
+            self.assertEqual(icons.getImage('snow').size, (188, 217))
+            self.assertTrue(icons.atlas.getImage('bg_188_217/ocean.png',
+                path.join(imageDir, 'bg_188_217', 'ocean.png')))
+        finally:
+            rmtree(folder)
+        
+    def testDpiTarget(self):
+        icons = drawboard.ArtLibrary([ drawboard.findBgData() ],
+            drawboard.getImageDir(), drawboard.base_url)
+        board = drawboard.Board('juno.m44')
+        hexWidth = 188/90.     # exactly 90 DPI at native size
+        native = board.render(icons, hexWidth=hexWidth)
+        scaled = board.render(icons, hexWidth=hexWidth, dpi=180)
+        self.assertEqual(native.info['dpi'], (90, 90))
+        self.assertEqual(scaled.info['dpi'], (180, 180))
+        for (n, s) in zip(native.size, scaled.size):
+            self.assertTrue(abs(2*n - s) < 4)
+
+    def testStreamedTiles(self):
+        icons = drawboard.ArtLibrary(
+            [ drawboard.findSedData(drawboard.app_dirs),
+              drawboard.findBgData() ],
+            drawboard.getImageDir(),
+            drawboard.base_url)
+        board = drawboard.Board('juno.m44')
+        folder = mkdtemp()
+        try:
+            with NoOutput():
+                cropped = splitimage.saveTiledImages(board.render(icons),
+                    path.join(folder, 'crop'), splitimage.page_sizes['letter'], 0.5, 0.25)
+                streamed = splitimage.saveTiledImages(
+                    drawboard.BoardRegions(board, icons, board.compile(icons)),
+                    path.join(folder, 'stream'), splitimage.page_sizes['letter'], 0.5, 0.25)
+            self.assertEqual(len(cropped), len(streamed))
+            for (f1, f2) in zip(cropped, streamed):
+                self.assertEqual(Image.open(f1).tobytes(), Image.open(f2).tobytes())
+        finally:
+            rmtree(folder)
+
+    def testStreamedFullSize(self):
+        icons = drawboard.ArtLibrary([ drawboard.findBgData() ],
+            drawboard.getImageDir(), drawboard.base_url)
+        board = drawboard.Board('juno.m44')
+        image = board.render(icons)
+        folder = mkdtemp()
+        try:
+            for encoder in sorted(splitimage.encoder_profiles):
+                with NoOutput():
+                    rendered = splitimage.saveTiledImages(image,
+                        path.join(folder, 'image-' + encoder), None, 0, 0, encoder=encoder)
+                    streamed = splitimage.saveTiledImages(
+                        drawboard.BoardRegions(board, icons, board.compile(icons)),
+                        path.join(folder, 'stream-' + encoder), None, 0, 0, encoder=encoder)
+                self.assertEqual(len(streamed), 1)
+                (f1, f2) = (rendered[0], streamed[0])
+                if encoder == 'pdf':
+                    with open(f2, 'rb') as f:
+                        pdf = f.read()
+                    self.assertTrue('/Count 1' in pdf)
+                else:
+                    self.assertEqual(Image.open(f1).mode, Image.open(f2).mode)
+                    self.assertEqual(Image.open(f1).tobytes(), Image.open(f2).tobytes())
+        finally:
+            rmtree(folder)
+
+    def testBands(self):
+        icons = drawboard.ArtLibrary(
+            [ drawboard.findSedData(drawboard.app_dirs),
+              drawboard.findBgData() ],
+            drawboard.getImageDir(),
+            drawboard.base_url)
+        renderer = drawboard.BandRenderer(icons, 3)
+        try:
+            for (scenario, skipLayers) in [('juno.m44', ['unit']),
+                    (benchmark.makeScenario('overlord', 'winter'), [])]:
+                board = drawboard.Board(scenario)
+                displayList = board.compile(icons)
+                serial = board.renderDisplayList(icons, displayList, skipLayers)
+                banded = renderer.render(displayList, skipLayers)
+                self.assertEqual(banded.size, serial.size)
+                self.assertEqual(banded.info['dpi'], serial.info['dpi'])
+                self.assertEqual(banded.tobytes(), serial.tobytes())
+        finally:
+            renderer.close()
+
+    def testRenderMemory(self):
+        # the board is painted in place on one image, border and all, with 
+        # no plate at print scale, so rendering it needs little more memory
+        # than the image itself, and its pages are cropped one at a time
+        script = ("import drawboard, benchmark, splitimage, sys; "
+            "icons = drawboard.openArtLibrary(imageURL=None); "
+            "board = drawboard.Board(benchmark.makeScenario('overlord', 'winter')); "
+            "displayList = board.compile(icons, dpi=180); "
+            "base = benchmark.peakMemory(); "
+            "image = board.renderDisplayList(icons, displayList, []); "
+            "rendered = benchmark.peakMemory(); "
+            "splitimage.saveTiledImages(image, sys.argv[1], "
+            "    splitimage.page_sizes['letter'], 0.5, 0.25, encoder='fast'); "
+            "print rendered - base, benchmark.peakMemory() - rendered, "
+            "    image.size[0] * image.size[1] * 4 / 2.**20")
+        folder = mkdtemp()
+        try:
+            output = check_output([sys.executable, '-c', script, 
+                path.join(folder, 'page')])
+        finally:
+            rmtree(folder)
+        (render_mb, tiles_mb, image_mb) = [float(v) for v in output.split()[-3:]]
+        self.assertTrue(image_mb > 100)
+        self.assertTrue(render_mb < 1.25 * image_mb, 
+            "rendering %.0fMB image took %.0fMB"%(image_mb, render_mb))
+        self.assertTrue(tiles_mb < 0.25 * image_mb, 
+            "saving pages of %.0fMB image took %.0fMB"%(image_mb, tiles_mb))
+
+    def testSVG(self):
+        icons = drawboard.ArtLibrary(
+            [ drawboard.findSedData(drawboard.app_dirs),
+              drawboard.findBgData() ],
+            drawboard.getImageDir(),
+            drawboard.base_url)
+        board = drawboard.Board('juno.m44')
+        displayList = board.compile(icons, dpi=120)
+        raster = board.renderDisplayList(icons, displayList)
+        ns = '{http://www.w3.org/2000/svg}'
+        href = '{http://www.w3.org/1999/xlink}href'
+        for embed in [False, True]:
+            svg = ElementTree.fromstring(board.renderSVG(icons, displayList, 
+                embed=embed))
+            self.assertEqual(svg.get('viewBox'), '0 0 %d %d'%raster.size)
+            self.assertAlmostEqual(float(svg.get('width')[:-2]), 
+                raster.size[0] / 120., 3)
+            
+            # each sprite is defined once, at the size it is pasted
+            images = dict((e.get('id'), e) for e in svg.iter(ns + 'image'))
+            hrefs = [e.get(href) for e in images.values()]
+            defs = [(e.get('width'), e.get('height'), e.get(href)) 
+                for e in images.values()]
+            self.assertEqual(len(set(defs)), len(defs))
+            self.assertEqual(any(h.startswith('file:') for h in hrefs), not embed)
+            
+            # the overlays are placed after the background hexes, in order
+            sprites = [op for op in displayList.ops if op[0] == 'sprite']
+            uses = list(svg.iter(ns + 'use'))[-len(sprites):]
+            for (op, e) in zip(sprites, uses):
+                image = images[e.get(href)[1:]]
+                self.assertEqual((int(e.get('x')), int(e.get('y'))), op[5:])
+                self.assertEqual((int(image.get('width')), int(image.get('height'))),
+                    icons.getDerived(*op[2:5]).size)
+            self.assertEqual(len(list(svg.iter(ns + 'line'))), 
+                len(board.flankDashes()[0]))
+            self.assertEqual([e.text for e in svg.iter(ns + 'text')],
+                [op[2] for op in displayList.ops if op[0] == 'label'])
+            
+        # skipped layers are left out
+        svg = ElementTree.fromstring(board.renderSVG(icons, displayList, 
+            ['lines', 'text']))
+        self.assertEqual(list(svg.iter(ns + 'line')), [])
+        self.assertEqual(len(list(svg.iter(ns + 'text'))), 1)     # the title
+
+    def testLibraryAPI(self):
+        library = lambda: drawboard.ArtLibrary(
+            [ drawboard.findSedData(drawboard.app_dirs),
+              drawboard.findBgData() ],
+            drawboard.getImageDir(),
+            drawboard.base_url)
+        icons = library()
+        with open('juno.m44', 'rb') as f:
+            text = f.read()
+        scenario = json.loads(text)
+        args = drawboard.renderOptions(page_size='a4', xlayers=[])
+        self.assertEqual(args.page_size, ['a4'])
+        self.assertRaises(TypeError, drawboard.renderOptions, pagesize='a4')
+        
+        # the same pages as the command line saves, without writing files
+        folder = mkdtemp()
+        try:
+            with NoOutput():
+                saved = drawboard.renderScenario(icons, 'juno.m44', 
+                    path.join(folder, 'juno'), args)
+            pages = drawboard.renderPages(icons, text, args, 'juno')
+            self.assertEqual(sorted(os.listdir(folder)), [path.basename(f) for f in saved])
+            self.assertEqual([name for (name, data) in pages], 
+                [path.basename(f) for f in saved])
+            for ((name, data), fname) in zip(pages, saved):
+                self.assertEqual(Image.open(StringIO(data)).tobytes(), 
+                    Image.open(fname).tobytes())
+        finally:
+            rmtree(folder)
+        self.assertEqual(drawboard.renderPages(icons, scenario, args, 'juno'), pages)
+        self.assertEqual(drawboard.renderImage(icons, scenario, args).tobytes(),
+            drawboard.Board('juno.m44').render(icons, []).tobytes())
+            
+        # threads sharing a new library get the same results
+        jobs = [drawboard.renderOptions(page_size=size, dpi_target=dpi, encoder=encoder)
+            for (size, dpi, encoder) in [('letter', None, 'png'), ('none', 120, 'png'), 
+                ('a4', 100, 'pdf'), ('letter', None, 'fast')]]
+        serial = [drawboard.renderPages(icons, text, job) for job in jobs]
+        icons = library()
+        drawboard.Board.plates.clear()
+        pool = ThreadPool(4)
+        try:
+            parallel = pool.map(lambda job: drawboard.renderPages(icons, text, job),
+                jobs)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual([[name for (name, data) in pages] for pages in parallel],
+            [[name for (name, data) in pages] for pages in serial])
+        for (pages, expected) in zip(parallel, serial):
+            for ((name, data), (_, expectedData)) in zip(pages, expected):
+                if name.endswith('.png'):
+                    self.assertEqual(Image.open(StringIO(data)).tobytes(), 
+                        Image.open(StringIO(expectedData)).tobytes())
+
+    def testDisplayList(self):
+        icons = drawboard.ArtLibrary(
+            [ drawboard.findSedData(drawboard.app_dirs),
+              drawboard.findBgData() ],
+            drawboard.getImageDir(),
+            drawboard.base_url)
+        board = drawboard.Board('juno.m44')
+        folder = mkdtemp()
+        try:
+            fname = path.join(folder, 'juno.json')
+            board.compile(icons, dpi=120).save(fname)
+            displayList = drawboard.DisplayList.load(fname)
+            replayed = displayList.board()
+            for skipLayers in [[], ['obstacle','unit'], ['terrain','lines','text']]:
+                self.assertEqual(
+                    replayed.renderDisplayList(icons, displayList, skipLayers).tobytes(),
+                    board.render(icons, skipLayers, dpi=120).tobytes())
+        finally:
+            rmtree(folder)
+        self.assertEqual(drawboard.DisplayList.load(fname), None)
+
+    def testWatch(self):
+        icons = drawboard.ArtLibrary(
+            [ drawboard.findSedData(drawboard.app_dirs),
+              drawboard.findBgData() ],
+            drawboard.getImageDir(),
+            drawboard.base_url)
+        folder = mkdtemp()
+        try:
+            scenario_file = path.join(folder, 'juno.m44')
+            copy('juno.m44', scenario_file)
+            args = drawboard.setupArgParser().parse_args([scenario_file])
+            watcher = drawboard.ScenarioWatcher(icons, scenario_file, 
+                path.join(folder, 'watch'), args)
+            with NoOutput():
+                outputs = watcher.update()
+                self.assertEqual(watcher.update(), [])
+                
+                # label one hex, and only the page(s) it is on are rewritten
+                with open(scenario_file) as f:
+                    scenario = json.load(f)
+                scenario['board']['labels'].append(
+                    { 'col' : 4, 'row' : 2, 'text' : ['Pegasus'] })
+                with open(scenario_file, 'w') as f:
+                    json.dump(scenario, f)
+                os.utime(scenario_file, (0, 0))
+                updated = watcher.update()
+                fresh = drawboard.renderScenario(icons, scenario_file, 
+                    path.join(folder, 'fresh'), args)
+            self.assertTrue(0 < len(updated) < len(outputs))
+            self.assertEqual(len(outputs), len(fresh))
+            for (f1, f2) in zip(outputs, fresh):
+                self.assertEqual(Image.open(f1).tobytes(), Image.open(f2).tobytes())
+        finally:
+            rmtree(folder)
+
+    def testManyOutputs(self):
+        icons = drawboard.ArtLibrary([ drawboard.findBgData() ],
+            drawboard.getImageDir(), drawboard.base_url)
+        folder = mkdtemp()
+        try:
+            parse = drawboard.setupArgParser().parse_args
+            args = parse(['juno.m44', '--hexwidth', '2.0866,3',
+                '--page_size', 'letter,A4,none'])
+            self.assertEqual(args.hexwidth, [2.0866, 3])
+            self.assertEqual(args.page_size, ['letter', 'a4', 'none'])
+            with NoOutput():
+                profiler = profiling.start()
+                try:
+                    outputs = drawboard.renderScenario(icons, 'juno.m44',
+                        path.join(folder, 'juno'), args)
+                finally:
+                    profiling.stop()
+            # the board is rendered once for both hex widths
+            self.assertEqual(profiler.summary()['board.render']['count'], 1)
+
+            for (hexWidth, width) in [(2.0866, '2.0866in'), (3, '3in')]:
+                for size in ['letter', 'a4', 'none']:
+                    with NoOutput():
+                        single = drawboard.renderScenario(icons, 'juno.m44',
+                            path.join(folder, 'single'), parse(['juno.m44',
+                                '--hexwidth', str(hexWidth), '--page_size', size]))
+                    base = path.join(folder, 'juno-%s-%s'%(width, size))
+                    many = [f for f in outputs if f[:-len('0101.png')] == base or
+                        f == base + '.png']
+                    self.assertEqual(len(many), len(single))
+                    for (f1, f2) in zip(many, single):
+                        self.assertEqual(Image.open(f1).tobytes(),
+                            Image.open(f2).tobytes())
+                        self.assertEqual(Image.open(f1).info['dpi'],
+                            Image.open(f2).info['dpi'])
+            self.assertEqual(len(set(outputs)), len(outputs))
+        finally:
+            rmtree(folder)
+
+    def testOutputCache(self):
+        icons = drawboard.ArtLibrary([ drawboard.findBgData() ],
+            drawboard.getImageDir(), drawboard.base_url)
+        folder = mkdtemp()
+        cacheFolder = path.join(drawboard.getCacheDir(icons.imageDir), 'outputs')
+        saved = drawboard.output_caches.pop(cacheFolder, None)
+        try:
+            cache = OutputCache(path.join(folder, 'cache'))
+            drawboard.output_caches[cacheFolder] = cache
+            scenario_file = path.join(folder, 'juno.m44')
+            copy('juno.m44', scenario_file)
+            parse = drawboard.setupArgParser().parse_args
+            args = parse([scenario_file, '--output-cache', '--page_size', 'letter,none'])
+            render = lambda name, args: drawboard.renderScenario(icons,
+                scenario_file, path.join(folder, name), args)
+            with NoOutput():
+                first = render('a', args)
+                second = render('b', args)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            self.assertEqual([f[len(folder) + 2:] for f in first],
+                [f[len(folder) + 2:] for f in second])
+            for (f1, f2) in zip(first, second):
+                self.assertEqual(os.stat(f1).st_ino, os.stat(f2).st_ino)
+
+            # other options miss, and rewriting the outputs leaves the cache alone
+            with NoOutput():
+                render('a', parse([scenario_file, '--output-cache',
+                    '--page_size', 'letter,none', '--nomarks']))
+                third = render('c', args)
+            self.assertEqual((cache.hits, cache.misses), (2, 2))
+            self.assertNotEqual(Image.open(first[0]).tobytes(),
+                Image.open(second[0]).tobytes())
+            for (f1, f2) in zip(second, third):
+                self.assertEqual(Image.open(f1).tobytes(), Image.open(f2).tobytes())
+
+            # as does a changed scenario
+            with open(scenario_file) as f:
+                scenario = json.load(f)
+            scenario['board']['labels'].append(
+                { 'col' : 4, 'row' : 2, 'text' : ['Pegasus'] })
+            with open(scenario_file, 'w') as f:
+                json.dump(scenario, f)
+            with NoOutput():
+                render('d', args)
+            self.assertEqual((cache.hits, cache.misses), (2, 3))
+
+            # trimming the cache removes the least recently used entries
+            entries = cache.entries()
+            self.assertEqual(len(entries), 3)
+            cache.maxBytes = entries[-1][1]
+            cache.evict()
+            self.assertEqual(cache.entries(), entries[-1:])
+            self.assertEqual(cache.evictions, 2)
+        finally:
+            drawboard.output_caches.pop(cacheFolder, None)
+            if saved:
+                drawboard.output_caches[cacheFolder] = saved
+            rmtree(folder)
+
+    def testProfile(self):
+        self.assertTrue(profiling.span('idle') is profiling.null_span)
+        folder = mkdtemp()
+        profiler = profiling.start()
+        try:
+            icons = drawboard.ArtLibrary(
+                [ drawboard.findSedData(drawboard.app_dirs), drawboard.findBgData() ],
+                drawboard.getImageDir(), None, atlasFile = False)
+            with NoOutput():
+                splitimage.saveTiledImages(drawboard.Board('juno.m44').render(icons),
+                    path.join(folder, 'juno'), splitimage.page_sizes['letter'], 0.5, 0.25)
+        finally:
+            self.assertTrue(profiling.stop() is profiler)
+        try:
+            summary = profiler.summary()
+            for name in ['art.index', 'compile.terrain', 'paint.terrain', 
+                    'paint.lines', 'paint.scenario', 'tiles.crop', 'tiles.save']:
+                self.assertTrue(name in summary, name)
+            self.assertEqual(summary['tiles.crop']['count'], 
+                summary['tiles.save']['count'])
+            self.assertTrue(profiler.counters['derived.miss'] > 0)
+            
+            profiler.save(path.join(folder, 'profile.json'))
+            with open(path.join(folder, 'profile.json')) as f:
+                saved = json.load(f)
+            self.assertEqual(len(saved['spans']), len(profiler.spans))
+            profiler.saveTrace(path.join(folder, 'trace.json'))
+            with open(path.join(folder, 'trace.json')) as f:
+                events = json.load(f)['traceEvents']
+            self.assertEqual(set(e['ph'] for e in events), set(['X']))
+            self.assertEqual(len(events), len(profiler.spans))
+        finally:
+            rmtree(folder)
+
+    def testGeometry(self):
+        board = drawboard.Board('juno.m44')
+        for scale in [1, 1.7]:
+            board.scale = scale
+            geometry = board.geometry()
+            self.assertTrue(geometry is board.geometry())
+            for row in xrange(board.rows):
+                for col in xrange(board.cols - row % 2):
+                    col2 = 2 * col + row % 2
+                    self.assertEqual(geometry.topLeft(row, col), 
+                        drawboard.Board.coords(row, col, scale))
+                    self.assertEqual(geometry.topLeft2(row, col2), 
+                        drawboard.Board.coords2(row, col2, scale))
+                    # every pixel of a hex (away from its edges) is hit
+                    (cx, cy) = geometry.centre(row, col)
+                    (w, h) = geometry.tileXY
+                    for (dx, dy) in [(0,0), (w/2 - 2, 0), (0, h/2 - 2), 
+                            (2 - w/2, h/4 - 2), (-4, 2 - h/2)]:
+                        self.assertEqual(geometry.hexAt((cx + dx, cy + dy)), 
+                            (row, col2))
+            # margins and the gaps at the ends of odd rows aren't on a hex
+            self.assertEqual(geometry.hexAt((1, 1)), None)
+            (x, y) = geometry.centre(1, board.cols - 1)
+            self.assertEqual(geometry.hexAt((x, y)), None)
+            self.assertEqual(geometry.hexAt(tuple(board.size() - XY(1,1))), None)
+            
+        board.scale = 1
+        geometry = board.geometry()
+        self.assertEqual(geometry.overlapping((0, 0, 60, 60)), [])
+        self.assertEqual(geometry.overlapping((200, 170, 220, 190)), [(0, 0)])
+        self.assertEqual(geometry.overlapping((240, 280, 260, 300)), 
+            [(0, 0), (0, 1), (1, 0)])
+        self.assertEqual(len(geometry.overlapping((0, 0) + tuple(board.size()))), 
+            board.cols * board.rows - board.rows / 2)
+        
+        # only the latest geometries are kept, however many scales are used
+        for n in xrange(2 * HexGeometry.max_tables):
+            board.scale = 1 + n / 100.
+            board.geometry()
+        self.assertEqual(len(HexGeometry.tables), HexGeometry.max_tables)
+        self.assertTrue(board.geometry() is board.geometry())
+        self.assertEqual(geometry.polygon(0, 0)[0], (62 + 94, 108))
+
+    def testPyramid(self):
+        # white, apart from a gradient in the top left
+        image = Image.new('RGB', (1000, 600), 'white')
+        image.paste(Image.linear_gradient('L').convert('RGB'), (100, 100))
+
+        # counts the crops made of the image
+        class Crops:
+            def __init__(self, image):
+                self.image = image
+                self.size = image.size
+                self.info = {}
+                self.boxes = []
+            def crop(self, box):
+                self.boxes.append(box)
+                return self.image.crop(box)
+        source = Crops(image)
+
+        folder = mkdtemp()
+        try:
+            basename = path.join(folder, 'board')
+            outputs = splitimage.savePyramid(source, basename, 256)
+            self.assertEqual(outputs[:2], [basename + '.dzi', basename + '.json'])
+            self.assertTrue('<Size Width="1000" Height="600"/>' in
+                open(basename + '.dzi').read())
+            with open(basename + '.json') as f:
+                manifest = json.load(f)
+            self.assertEqual(len(manifest['levels']), 11)
+            self.assertEqual(manifest['levels'][0], [1, 1])
+            self.assertEqual(manifest['levels'][-2], [500, 300])
+            self.assertEqual(source.boxes, [(0, 0, 1000, 600)])  # one block
+
+            # every tile is either written or skipped as background
+            skipped = set(tuple(t) for t in manifest['skipped'])
+            for (level, (w, h)) in enumerate(manifest['levels']):
+                for row in xrange((h + 255) / 256):
+                    for col in xrange((w + 255) / 256):
+                        fname = path.join(basename + '_files', str(level),
+                            '%d_%d.png'%(col, row))
+                        self.assertNotEqual(fname in outputs,
+                            (level, col, row) in skipped)
+            self.assertEqual(sorted(t[1:] for t in skipped if t[0] == 10),
+                [(0, 2), (1, 2), (2, 0), (2, 1), (2, 2), (3, 0), (3, 1), (3, 2)])
+
+            # the last level is the image itself
+            tile = Image.open(path.join(basename + '_files', '10', '1_1.png'))
+            self.assertEqual(tile.size, (256, 256))
+            self.assertEqual(tile.tobytes(), image.crop((256, 256, 512, 512)).tobytes())
+        finally:
+            rmtree(folder)
+
+    def testEncoders(self):
+        icons = drawboard.ArtLibrary([ drawboard.findBgData() ],
+            drawboard.getImageDir(), drawboard.base_url)
+        image = drawboard.Board('juno.m44').render(icons)
+        letter = splitimage.page_sizes['letter']
+        folder = mkdtemp()
+        try:
+            with NoOutput():
+                report = splitimage.compareEncoders(image, letter, 0.5, 0.25)
+                outputs = dict((encoder, splitimage.saveTiledImages(image, 
+                        path.join(folder, encoder), letter, 0.5, 0.25, encoder=encoder))
+                    for encoder in ['png', 'fast', 'palette', 'pdf'])
+            self.assertEqual([r[:2] for r in report], 
+                [('fast', 8), ('palette', 8), ('pdf', 1), ('png', 8)])
+            
+            for (f1, f2, f3) in zip(outputs['png'], outputs['fast'], outputs['palette']):
+                self.assertEqual(Image.open(f1).tobytes(), Image.open(f2).tobytes())
+                self.assertEqual(Image.open(f3).mode, 'P')
+                self.assertEqual(Image.open(f3).size, Image.open(f1).size)
+                
+            # one pdf, with a letter-size page for each tile
+            self.assertEqual(outputs['pdf'], [path.join(folder, 'pdf.pdf')])
+            with open(outputs['pdf'][0], 'rb') as f:
+                pdf = f.read()
+            self.assertTrue('/Count 8' in pdf)
+            self.assertEqual(pdf.count('/MediaBox [ 0 0 612 792 ]'), 8)
+            self.assertEqual(pdf.count('/DCTDecode'), 8)      # JPEG, as documented
+        finally:
+            rmtree(folder)
+
+    def testParallelEncoding(self):
+        icons = drawboard.ArtLibrary([ drawboard.findBgData() ],
+            drawboard.getImageDir(), drawboard.base_url)
+        image = drawboard.Board('juno.m44').render(icons)
+        folder = mkdtemp()
+        try:
+            with NoOutput():
+                serial = splitimage.saveTiledImages(image, path.join(folder, 'a'),
+                    splitimage.page_sizes['a4'], 0.5, 0.25)
+                threads = splitimage.saveTiledImages(image, path.join(folder, 'b'),
+                    splitimage.page_sizes['a4'], 0.5, 0.25, encoders=3)
+                processes = splitimage.saveTiledImages(image, path.join(folder, 'c'),
+                    splitimage.page_sizes['a4'], 0.5, 0.25, encoders=2, processes=True)
+            for outputs in [threads, processes]:
+                self.assertEqual([path.basename(f)[1:] for f in outputs],
+                    [path.basename(f)[1:] for f in serial])
+                for (f1, f2) in zip(serial, outputs):
+                    self.assertEqual(Image.open(f1).tobytes(), Image.open(f2).tobytes())
+        finally:
+            rmtree(folder)
+
+    def testBandedSplit(self):
+        folder = mkdtemp()
+        try:
+            # a 108MB image (144MB decoded), written a row at a time
+            (w, h) = (6000, 6000)
+            source = path.join(folder, 'huge.ppm')
+            pattern = bytearray(i % 251 for i in xrange(3*w + 251))
+            with open(source, 'wb') as f:
+                f.write('P6\n%d %d\n255\n'%(w, h))
+                for y in xrange(h):
+                    f.write(pattern[y % 251:y % 251 + 3*w])
+
+            # split it within 64MB, reporting the peak memory of splitimage
+            script = ("import resource, subprocess, sys; "
+                "subprocess.check_call(sys.argv[1:], stdout=open('/dev/null', 'w')); "
+                "print resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss")
+            output = check_output([sys.executable, '-c', script,
+                sys.executable, 'splitimage.py', source, path.join(folder, 'page.png'),
+                '--dpi', '100', '--nomarks', '--encoder', 'fast', '--max_memory', '64'])
+            peak_mb = int(output.split()[-1]) / 1024.
+            if sys.platform == 'darwin':
+                peak_mb /= 1024
+            self.assertTrue(peak_mb < 64 + 40, "peak memory %.0fMB"%peak_mb)
+
+            image = Image.open(source)
+            with NoOutput():
+                boxes = splitimage.planTiles(XY(w, h), splitimage.page_sizes['letter'],
+                    0.5, 0.25, 100)[0]
+            pages = sorted(glob(path.join(folder, 'page*.png')))
+            self.assertEqual(len(pages), len(boxes))
+            for ((i, j, box), fname) in [(boxes[0], pages[0]), (boxes[-1], pages[-1])]:
+                self.assertEqual(path.basename(fname), 'page%02d%02d.png'%(i+1, j+1))
+                self.assertEqual(Image.open(fname).tobytes(), image.crop(box).tobytes())
+
+            # a page bigger than the limit can't be split
+            self.assertRaises(ValueError,
+                splitimage.BandedImage(source, 4 * 2**20).crop, boxes[0][2])
+        finally:
+            rmtree(folder)
+
+# a local stand-in for the art server, serving files from a folder and 
+# failing the first request for any path listed in flaky
+class ArtRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'       # keep connections alive
+    
+    def translate_path(self, urlpath):
+        return path.join(self.server.folder, urlpath.lstrip('/'))
+        
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path in self.server.flaky:
+            self.server.flaky.remove(self.path)
+            self.send_error(503)
+        else:
+            SimpleHTTPRequestHandler.do_GET(self)
+            
+    def log_message(self, format, *args):
+        pass
+
+class ArtServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FetchTests(unittest.TestCase):
+    def setUp(self):
+        self.folder = mkdtemp()
+        os.makedirs(path.join(self.folder, 'server', 'art'))
+        for name in ['snow', 'ocean', 'coast']:
+            copy(path.join(drawboard.getImageDir(), 'bg_188_217', name + '.png'),
+                path.join(self.folder, 'server', 'art'))
+        self.server = ArtServer(('127.0.0.1', 0), ArtRequestHandler)
+        self.server.folder = path.join(self.folder, 'server')
+        self.server.requests = []
+        self.server.flaky = ['/art/ocean.png']
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/'%self.server.server_port
+        
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        rmtree(self.folder)
+        
+    def testFetchAll(self):
+        cacheFile = path.join(self.folder, 'missing.json')
+        fetcher = artfetch.Fetcher(self.url, artfetch.NegativeCache(cacheFile),
+            backoff = 0.01)
+        local = path.join(self.folder, 'local')
+        items = [('art/%s.png'%name, path.join(local, 'art', name + '.png'))
+            for name in ['snow', 'ocean', 'coast', 'missing']]
+        results = fetcher.fetchAll(items, jobs = 2)
+        
+        self.assertEqual(results, {'art/snow.png': True, 'art/ocean.png': True,
+            'art/coast.png': True, 'art/missing.png': False})
+        for (relpath, fname) in items[:3]:
+            self.assertTrue(Image.open(fname).size, (188, 217))
+        # the flaky file was retried after the server error
+        self.assertEqual(self.server.requests.count('/art/ocean.png'), 2)
+        
+        # failures are remembered across runs until they expire
+        fetcher = artfetch.Fetcher(self.url, artfetch.NegativeCache(cacheFile))
+        self.assertFalse(fetcher.fetch(*items[3]))
+        self.assertEqual(self.server.requests.count('/art/missing.png'), 1)
+        
+        fetcher = artfetch.Fetcher(self.url, 
+            artfetch.NegativeCache(cacheFile, ttl = 0))
+        self.assertFalse(fetcher.fetch(*items[3]))
+        self.assertEqual(self.server.requests.count('/art/missing.png'), 2)
+        
+    def testPrefetch(self):
+        xml = path.join(self.folder, 'art.xml')
+        with open(xml, 'w') as f:
+            f.write('''<art>
+                <item><name>snow</name><icon>art/snow.png</icon></item>
+                <item><name>ocean</name><icon>art/ocean.png</icon></item>
+                <item><name>unused</name><icon>art/coast.png</icon></item>
+            </art>''')
+        local = path.join(self.folder, 'local')
+        icons = drawboard.ArtLibrary([xml], local, self.url, indexFile = False,
+            negativeCacheFile = path.join(self.folder, 'missing.json'))
+        icons.fetcher.backoff = 0.01
+        icons.prefetch([('snow',1), ('ocean',1), ('nonesuch',1)])
+        self.assertTrue(path.isfile(path.join(local, 'art', 'snow.png')))
+        self.assertTrue(path.isfile(path.join(local, 'art', 'ocean.png')))
+        self.assertFalse(path.exists(path.join(local, 'art', 'coast.png')))
+        
+        # images already on disk are used without asking the server
+        requests = len(self.server.requests)
+        self.assertTrue(icons.getImage('snow'))
+        self.assertEqual(len(self.server.requests), requests)
+
+class ServiceTests(unittest.TestCase):
+    def setUp(self):
+        icons = drawboard.openArtLibrary(imageURL = None)
+        self.service = renderservice.RenderService(icons, workers = 2)
+        self.server = renderservice.RenderServer(self.service, ('127.0.0.1', 0))
+        thread = Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        with open('juno.m44', 'rb') as f:
+            self.scenario = f.read()
+        
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.close()
+        
+    def request(self, method, url, body = None):
+        conn = httplib.HTTPConnection('127.0.0.1', self.server.server_port)
+        conn.request(method, url, body)
+        response = conn.getresponse()
+        data = response.read()
+        conn.close()
+        return (response.status, response.getheader('Content-Type'), data)
+        
+    def testConcurrentRenders(self):
+        # workers share the library, so start with nothing loaded
+        drawboard.Board.plates.clear()
+        results = []
+        def render():
+            results.append(self.request('POST', 
+                '/render?page_size=none&dpi_target=100', self.scenario))
+        threads = [Thread(target=render) for i in xrange(4)]
+        with NoOutput():
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual([r[0] for r in results], [200] * 4)
+        pixels = [Image.open(StringIO(r[2])).tobytes() for r in results]
+        self.assertTrue(all(p == pixels[0] for p in pixels))
+        
+    def testRender(self):
+        with NoOutput():
+            (status, content_type, data) = self.request('POST', 
+                '/render?page_size=none&xlayers=none', self.scenario)
+            self.assertEqual((status, content_type), (200, 'image/png'))
+            image = Image.open(StringIO(data))
+            icons = drawboard.openArtLibrary(imageURL = None)
+            board = drawboard.Board('juno.m44').render(icons)
+            self.assertEqual(image.tobytes(), board.tobytes())
+            
+            (status, content_type, data) = self.request('POST', 
+                '/render?page_size=a4&nomarks=true', self.scenario)
+            self.assertEqual((status, content_type), (200, 'application/zip'))
+            names = ZipFile(StringIO(data)).namelist()
+            self.assertTrue(len(names) > 1)
+            self.assertTrue(all(n.startswith('board') for n in names))
+            
+        for query in ['page_size=huge', 'colour=red']:
+            self.assertEqual(self.request('POST', '/render?' + query, 
+                self.scenario)[0], 400)
+        self.assertEqual(self.request('POST', '/render', '{not json')[0], 400)
+        self.assertEqual(self.request('GET', '/render')[0], 404)
+        
+        (status, content_type, data) = self.request('GET', '/metrics')
+        metrics = json.loads(data)
+        self.assertEqual((metrics['requests'], metrics['completed'], 
+            metrics['failed'], metrics['queue_depth']), (5, 2, 3, 0))
+        self.assertEqual(metrics['latency']['count'], 2)
+        self.assertTrue(metrics['art_cache']['resident_bytes'] > 0)
+        self.assertTrue(metrics['label_cache']['resident_bytes'] > 0)
+        self.assertTrue(metrics['plate_cache']['max_bytes'] > 0)
+
+class BenchmarkTests(unittest.TestCase):
+    def testSyntheticScenario(self):
+        for format in drawboard.Board.formats:
+            for face in drawboard.Board.faces:
+                scenario = benchmark.makeScenario(format, face)
+                board = drawboard.Board(scenario)
+                self.assertEqual((board.format, board.face), (format, face))
+                hexagons = scenario['board']['hexagons']
+                self.assertEqual(len(hexagons), 
+                    board.cols * board.rows - board.rows / 2)
+                self.assertTrue(all(h.has_key('terrain') for h in hexagons))
+        self.assertEqual(benchmark.makeScenario('standard', 'winter', 3),
+            benchmark.makeScenario('standard', 'winter', 3))
+        
+        # rendered with every kind of overlay
+        icons = drawboard.openArtLibrary(imageURL = None)
+        board = drawboard.Board(benchmark.makeScenario('standard', 'country'))
+        ops = board.compile(icons).ops
+        for layer in drawboard.Board.drawing_layers:
+            self.assertTrue(any(op[1] == layer for op in ops))
+        self.assertTrue(('sprite', 'unit', 'nbr_units') in [op[:3] for op in ops])
+        self.assertTrue(('sprite', 'unit', 'badge1') in [op[:3] for op in ops])
+        
+    def testCompareResults(self):
+        baseline = { 'render_s' : 1.0, 'encode_s' : 0.01, 'peak_mb' : 100 }
+        self.assertEqual(benchmark.compareResults(baseline, 
+            { 'render_s' : 1.2, 'encode_s' : 0.025, 'peak_mb' : 130, 'new_s' : 9 }), [])
+        self.assertEqual(benchmark.compareResults(baseline, 
+            { 'render_s' : 1.3, 'encode_s' : 0.04, 'peak_mb' : 150 }),
+            [('encode_s', 0.01, 0.04), ('peak_mb', 100, 150), ('render_s', 1.0, 1.3)])
+
 class ArgsTests(unittest.TestCase):
     def testHelp(self):
         with NoOutput():
@@ -66,12 +1040,34 @@ class ArgsTests(unittest.TestCase):
             'outputbase.png',
             '--appdir','/some/dir',
             '--hexwidth','1.5',
+            '--dpi-target','300',
+            '--stream',
+            '--encoders','4',
+            '--encode_processes',
+            '--encoder','palette',
+            '--compare_encoders',
             '--page_size','letter',
             '--margin','0.5',
             '--overlap','0.25',
             '--xlayers','terrain,lines,rect_terrain,obstacle,unit,tags,text'
         ]))      
         
+    def testBatchValid(self):
+        args = drawboard.setupArgParser().parse_args([
+            '--batch','scenarios',
+            '--jobs','4'
+        ])
+        self.assertEqual(args.batch, 'scenarios')
+        self.assertEqual(args.jobs, 4)
+        self.assertEqual(args.scenario_file, None)
+        
+    def testBuildAtlasValid(self):
+        args = drawboard.setupArgParser().parse_args(['--build-atlas'])
+        self.assertTrue(args.build_atlas)
+        self.assertEqual(args.scenario_file, None)
+        self.assertFalse(drawboard.setupArgParser().parse_args([
+            'scenario.m44']).build_atlas)
+        
     def testBadPageChoice(self):
         with NoOutput():
             self.assertRaises(SystemExit, drawboard.setupArgParser().parse_args,
@@ -107,6 +1103,13 @@ class CommandLineTests(unittest.TestCase):
         self.runArgs(['juno.m44','-x','none'])
         removeImages('juno')
         
+    def testSVG(self):
+        self.runArgs(['juno.m44','--svg','link','--hexwidth','2,3'])
+        for fname in ['juno-2in.svg', 'juno-3in.svg']:
+            self.assertTrue(path.isfile(fname))
+            os.remove(fname)
+        self.assertEqual(glob('juno*.png'), [])
+        
     def testXOption(self):
         self.runArgs(['-x','none','juno.m44'])
         removeImages('juno')
@@ -114,6 +1117,23 @@ class CommandLineTests(unittest.TestCase):
     def testMissingScenario(self):
         self.runArgs(['foobar'], False)
         
+    def testBatch(self):
+        folder = mkdtemp()
+        try:
+            for name in ['one','two','three']:
+                copy('juno.m44', path.join(folder, name + '.m44'))
+            with open(path.join(folder, 'broken.m44'), 'w') as f:
+                f.write('{ not json')
+            # a broken scenario is reported, and fails the run
+            self.runArgs(['--batch', folder, '-j', '2', '-p', 'none'], False)
+            for name in ['one','two','three']:
+                self.assertTrue(path.isfile(path.join(folder, name + '.png')))
+        finally:
+            rmtree(folder)
+            
+    def testMissingBatchFolder(self):
+        self.runArgs(['--batch','foobar'], False)
+        
     
     def tryScenario(self, scenario):
         self.runArgs(['-x','none', scenario])